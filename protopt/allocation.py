@@ -0,0 +1,74 @@
+import logging
+import os
+import subprocess
+import time
+
+from protopt.experiment import walltime_to_seconds
+
+
+logger = logging.getLogger()
+
+
+def detect_remaining_walltime():
+    # Remaining time of the current Slurm job, None if not in a job
+    job_id = os.environ.get("SLURM_JOB_ID")
+    if job_id is None:
+        return None
+
+    try:
+        output = subprocess.check_output(
+            ["squeue", "-h", "-j", job_id, "-o", "%L"],
+            universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    # squeue uses D-HH:MM:SS
+    try:
+        return walltime_to_seconds(output.replace("-", ":"))
+    except ValueError:
+        logger.debug("Cannot parse remaining walltime: %s" % output)
+        return None
+
+
+class Allocation(object):
+    # Keeps track of the time left before the scheduler kills the worker. The
+    # margin is the time needed to stop a trial and save its state cleanly.
+
+    def __init__(self, walltime=None, margin=300):
+        self.start_time = time.time()
+        self.walltime = walltime
+        self.margin = margin
+
+    @classmethod
+    def detect(cls, walltime=None, margin=300):
+        if walltime is not None:
+            walltime = walltime_to_seconds(walltime)
+        else:
+            walltime = detect_remaining_walltime()
+
+        if walltime is None:
+            logger.info("Walltime unknown, running without time limit")
+        else:
+            logger.info("Walltime of %d seconds" % walltime)
+
+        return cls(walltime, margin)
+
+    def elapsed(self):
+        return time.time() - self.start_time
+
+    def remaining(self):
+        if self.walltime is None:
+            return None
+
+        return self.walltime - self.margin - self.elapsed()
+
+    def is_expired(self):
+        remaining = self.remaining()
+        return remaining is not None and remaining <= 0
+
+    def sleep(self, seconds):
+        # Never sleep past the end of the allocation
+        remaining = self.remaining()
+        if remaining is not None:
+            seconds = max(min(seconds, remaining), 0)
+        time.sleep(seconds)
@@ -1,14 +1,21 @@
 import argparse
+import copy
 import getpass
 import logging
 import os
-import random
 import sys
+import time
 
+from protopt.allocation import Allocation
 from protopt.database import Database
 from protopt.experiment import Experiment
+from protopt.fairshare import FairShare
+from protopt.generator import generator_loop
+from protopt.wrapper import fork_server, preemption
+from protopt.pool import WorkerPool, detect_slots
 from protopt.optimizer import Optimizer
-from protopt.utils import SacredSelectionError, Interrupt, ClusterProblem
+from protopt.utils import (
+    SacredSelectionError, Interrupt, ClusterProblem, LostClaim, StagingProblem)
 from protopt.sacred_commandline_options import SelectOption, EnforceNewOption
 
 
@@ -61,6 +68,57 @@ def build_parser(project_name, models):
               "to --pool-size but should keep their number around this "
               "approximately."))
 
+    parser.add_argument(
+        "--cost-aware", action="store_true",
+        help=("Favor candidates with the best expected improvement per "
+              "second of runtime, learned from completed trials."))
+
+    parser.add_argument(
+        "--generator", action="store_true",
+        help=("Do not run any trial, only keep --pool-size runnable trials "
+              "queued for the workers. Does not require a GPU."))
+
+    parser.add_argument(
+        "--no-sampling", action="store_true",
+        help=("Never sample new candidates in this worker. Wait for a "
+              "generator (see --generator) to queue new ones instead."))
+
+    parser.add_argument(
+        "--sleep-interval", type=int, default=60,
+        help=("Seconds to wait before looking again at the queue when "
+              "there is nothing to do. Default is 60."))
+
+    parser.add_argument(
+        "--lease-ttl", type=int, default=600,
+        help=("Seconds for which a worker keeps the exclusive right to "
+              "sample new candidates. Default is 600."))
+
+    parser.add_argument(
+        "--trial-lease-ttl", type=int, default=300,
+        help=("Seconds without heartbeat after which a RUNNING trial is "
+              "considered lost and set back to INTERRUPTED. Default is 300."))
+
+    parser.add_argument(
+        "--serve", nargs="*", default=[], metavar="NAME[:WEIGHT]",
+        help=("Names of other experiments of the same model run by this "
+              "worker, each with an optional weight. The wall time of "
+              "trials is shared between experiments in proportion to "
+              "their weight."))
+
+    parser.add_argument(
+        "--weight", type=float, default=1.,
+        help="Weight of this experiment when using --serve. Default is 1.")
+
+    parser.add_argument(
+        "--warm-start-from", nargs="*", default=[],
+        help=("Names of related experiments whose completed trials are used "
+              "to warm-start the optimizer. All their profiles are used."))
+
+    parser.add_argument(
+        "--warm-start-weight", type=float, default=0.5,
+        help=("Weight between 0 and 1 of the observations coming from "
+              "--warm-start-from experiments. Default is 0.5."))
+
     parser.add_argument(
         "--host-names", default=["localhost"], nargs="*",
         help="Host where the mongoDB database is to store configurations and "
@@ -101,6 +159,42 @@ def build_parser(project_name, models):
 
     parser.add_argument('--gpu-id', type=int, default=0)
 
+    parser.add_argument(
+        "--walltime",
+        help=("Walltime of the job (DD:HH:MM:SS, HH:MM:SS, MM:SS or S). "
+              "The worker keeps running trials until it is about to expire. "
+              "Detected with squeue inside Slurm jobs if not given."))
+
+    parser.add_argument(
+        "--walltime-margin", type=int, default=300,
+        help=("Seconds before the end of the walltime at which the worker "
+              "stops taking trials. Default is 300."))
+
+    parser.add_argument(
+        "--max-trials", type=int,
+        help=("Stop the worker after this many launches of trials, "
+              "whether they succeed or not."))
+
+    parser.add_argument(
+        "--fork-server", action="store_true",
+        help=("Start the fork server running the training functions of "
+              "experiments built with wrapper.fork_fct_signature(). Required "
+              "by those experiments only."))
+
+    parser.add_argument(
+        "--workers", type=int, default=1,
+        help=("Number of trials to run concurrently on this node. 0 means "
+              "as many as the available GPU and CPU slots allow. "
+              "Default is 1, which uses --gpu-id."))
+
+    parser.add_argument(
+        "--trials-per-gpu", type=int, default=1,
+        help="How many trials can share a GPU. Default is 1.")
+
+    parser.add_argument(
+        "--cores-per-trial", type=int, default=1,
+        help="How many CPU cores each trial needs. Default is 1.")
+
     parser.add_argument(
         '-v', '--verbose', action='count', default=0,
         help="Print informations about the process.\n"
@@ -138,52 +232,205 @@ def parse_args(project, models, argv):
     if len(opt.ports) == 1:
         opt.ports = opt.ports * len(opt.host_names)
 
+    # Before the connection to the database starts its threads
+    if opt.fork_server and not opt.generator:
+        fork_server.start()
+
     return opt
 
 
 def build_database(opt):
     return Database(opt.database_name, opt.experiment_name + "_runs",
                     opt.host_names, opt.ports, opt.user_name, opt.password,
-                    opt.ssl, opt.ssl_ca_file, opt.replica_set, opt.auth_source)
+                    opt.ssl, opt.ssl_ca_file, opt.replica_set, opt.auth_source,
+                    getattr(opt, "trial_lease_ttl", 300))
 
 
-def build_optimizer(pool_size, space):
-    return Optimizer(pool_size, space)
+def build_optimizer(pool_size, space, cost_aware=False):
+    return Optimizer(pool_size, space, cost_aware=cost_aware)
 
 
-def build_experiment(name, fct, validate_on, space, database, optimizer):
+def build_experiment(name, fct, validate_on, space, database, optimizer,
+                     lease_ttl=600, sources=None, source_weight=0.5):
 
     dir_path = os.path.join(os.getcwd(), name)
 
     experiment = Experiment(
         name=name, dir_path=dir_path, fct=fct,
         validate_on=validate_on, space=space,
-        optimizer=optimizer, database=database)
+        optimizer=optimizer, database=database,
+        lease_ttl=lease_ttl, sources=sources, source_weight=source_weight)
 
     return experiment
 
 
-def main_loop(experiment, resilience=10):
-
+def build_sources(opt, space):
+    sources = []
+    for name in opt.warm_start_from:
+        source_opt = copy.copy(opt)
+        source_opt.experiment_name = name
+        # Trials of every profiles can be mapped in our space
+        source_opt.profiles = []
+
+        source_space = type(space)(space.model, space.defaults, source_opt)
+        sources.append(build_experiment(
+            name, None, opt.validate_on, source_space,
+            build_database(source_opt), optimizer=None))
+
+    return sources
+
+
+def build_served(opt, experiment):
+    # Other experiments run by the same workers, see multi_loop()
+    experiments = []
+    weights = []
+    for spec in opt.serve:
+        name, _, weight = spec.partition(":")
+        served_opt = copy.copy(opt)
+        served_opt.experiment_name = name
+
+        space = type(experiment.space)(experiment.space.model,
+                                       experiment.space.defaults, served_opt)
+        experiments.append(build_experiment(
+            name, experiment.fct, experiment.validate_on, space,
+            build_database(served_opt),
+            build_optimizer(opt.pool_size, space, opt.cost_aware),
+            lease_ttl=opt.lease_ttl))
+        weights.append(float(weight) if weight else 1.)
+
+    return experiments, weights
+
+
+def run(experiment, opt):
+    if opt.generator:
+        generator_loop(experiment, opt.pool_size, opt.sleep_interval)
+        return
+
+    # Every worker of the process runs trials until the allocation ends,
+    # reusing the connection, the compiled space and the optimizer.
+    allocation = Allocation.detect(opt.walltime, opt.walltime_margin)
+    # Installed here so that workers of a pool are covered too
+    preemption.install()
+    loop_kwargs = dict(force_new=not opt.no_sampling,
+                       sleep_interval=opt.sleep_interval,
+                       allocation=allocation, max_trials=opt.max_trials)
+
+    loop = main_loop
+    experiments = experiment
+    if opt.serve:
+        served, weights = build_served(opt, experiment)
+        loop = multi_loop
+        experiments = [experiment] + served
+        loop_kwargs["weights"] = [opt.weight] + weights
+
+    if opt.workers != 1:
+        slots = detect_slots(opt.workers, opt.trials_per_gpu,
+                             opt.cores_per_trial)
+        # Concurrent runs in the same process cannot capture file descriptors
+        for served in (experiments if opt.serve else [experiment]):
+            served.capture_mode = "no"
+        pool = WorkerPool(loop, experiments, slots, **loop_kwargs)
+        pool.run()
+    else:
+        loop(experiments, **loop_kwargs)
+
+
+def main_loop(experiment, resilience=10, force_new=True, sleep_interval=60,
+              allocation=None, max_trials=None):
+    multi_loop([experiment], resilience=resilience, force_new=force_new,
+               sleep_interval=sleep_interval, allocation=allocation,
+               max_trials=max_trials)
+
+
+def multi_loop(experiments, weights=None, resilience=10, force_new=True,
+               sleep_interval=60, allocation=None, max_trials=None):
+
+    if allocation is None:
+        allocation = Allocation()
+
+    share = FairShare(experiments, weights)
+
+    n_trials = 0
     while resilience > 0:
 
-        trials = experiment.get_runnable_trials()
-        skip = random.randint(1, 5)
-        iter_trials = iter(trials)
-        logger.debug("Skipping %d trials" % skip)
-        for i in range(skip):
+        if preemption.requested:
+            logger.info("Preempted by the scheduler, stopping the worker")
+            return
+
+        if allocation.is_expired():
+            logger.info("Walltime almost expired, stopping the worker")
+            return
+
+        if max_trials is not None and n_trials >= max_trials:
+            logger.info("Launched %d trials, stopping the worker" % n_trials)
+            return
+
+        # Runnable trials of the most underserved experiment first. New
+        # candidates are only sampled when every experiment is starved.
+        trial = None
+        too_long = []
+        for experiment in share.iter_by_priority():
+            # Trials lost by dead workers become runnable again
+            experiment.database.reap_expired_trials()
+
+            trial = _select_trial(experiment, allocation, too_long)
+            if trial is not None:
+                break
+
+        if trial is None and too_long:
+            logger.info("Not enough walltime left for any of the runnable "
+                        "trials, stopping the worker")
+            return
+        elif trial is None and not force_new:
+            logger.info("No runnable trials, waiting for the generator")
             try:
-                trial = next(iter_trials)
-                logger.debug("Skipping %d-th with id %d" % (i, trial.id))
-            except StopIteration:
-                # TODO FINISH
-                if i == 0:
-                    raise RuntimeError("Experiment could not return any "
-                                       "runnable trials")
-
-        logger.debug("Selected %d-th trial with id %d" % (i, trial.id))
+                allocation.sleep(sleep_interval)
+            except KeyboardInterrupt:
+                logger.info("Interruption requested by user")
+                return
+            continue
+        elif trial is None:
+            # Fitting the optimizer can take most of the grace period
+            if preemption.requested:
+                logger.info("Preempted by the scheduler, stopping the worker")
+                return
+
+            experiment = next(share.iter_by_priority())
+
+            # A new trial typically needs the median time to its first
+            # checkpoint, don't sample one which could not reach it
+            remaining = allocation.remaining()
+            estimate = experiment.get_duration_model().estimate({})
+            if (remaining is not None and estimate is not None and
+                    estimate > remaining):
+                logger.info("Not enough walltime left for a new trial "
+                            "(%d seconds needed, %d left), stopping the "
+                            "worker" % (estimate, remaining))
+                return
+
+            trial = _select_trial(experiment, allocation, too_long,
+                                  force_new=True)
+
+            if preemption.requested:
+                logger.info("Preempted by the scheduler while sampling, "
+                            "stopping the worker")
+                return
+
+            if trial is None and too_long:
+                logger.info("Not enough walltime left for any of the new "
+                            "trials, stopping the worker")
+                return
+
+        if trial is None:
+            raise RuntimeError("Experiment could not return any "
+                               "runnable trials")
+
         # Try to launch it. If another process select it between
         # select_random_config() and run(), run() will raise a ValueError
+        start_time = time.time()
+        # Every attempt counts, a worker which keeps losing races or failing
+        # must stop too
+        n_trials += 1
         try:
             trial.run()
         except SacredSelectionError as e:
@@ -191,10 +438,18 @@ def main_loop(experiment, resilience=10):
                         "condition with another worker.\n %s" %
                         (trial.id, str(e)))
             experiment.exclude(trial)
+        except LostClaim as e:
+            logger.info("Trial %d was reaped while running and claimed by "
+                        "another worker, dropped it.\n %s" %
+                        (trial.id, str(e)))
         except ClusterProblem as e:
             logger.info("Failed to launch %d because of a problem "
                         "on the cluster:\n %s" % (trial.id, str(e)))
             experiment.exclude(trial)
+        except StagingProblem as e:
+            logger.info("Failed to stage the data of %d on this node, left "
+                        "it to other workers:\n %s" % (trial.id, str(e)))
+            experiment.exclude(trial)
         except Interrupt as e:
             if "File not available" in str(e):
                 logger.info("Wrong cluster, skipped job %d" % trial.id)
@@ -211,6 +466,43 @@ def main_loop(experiment, resilience=10):
             resilience -= 1
             logger.info("Resilience now at %d" % resilience)
 
+        share.charge(experiment, time.time() - start_time)
+
         # If killed by timeout, the worker will be rescheduler by
         # SmartDispatch and it will look again for a job in the db, which
         # could be the one paused that resume
+
+
+def _select_trial(experiment, allocation, too_long, force_new=False):
+    trials = experiment.get_runnable_trials(force_new=force_new)
+
+    # Only take trials which can reach a checkpoint before the end of the
+    # allocation
+    remaining = allocation.remaining()
+    if remaining is not None:
+        trials = _filter_fitting(trials, experiment.get_duration_model(),
+                                 remaining, too_long)
+
+    # Sorted by priority. A trial claimed by another worker in the meantime
+    # is excluded after a failed launch and the next one is taken.
+    trial = next(iter(trials), None)
+
+    if trial is not None:
+        logger.debug("Selected trial with id %d of %s" %
+                     (trial.id, experiment.name))
+
+    return trial
+
+
+def _filter_fitting(trials, duration_model, remaining, too_long):
+    for trial in trials:
+        estimate = (duration_model.estimate(trial.row)
+                    if trial.row is not None else None)
+        if estimate is not None and estimate > remaining:
+            logger.debug("Trial %d needs %d seconds, only %d left" %
+                         (trial.id, estimate, remaining))
+            too_long.append(trial)
+            continue
+
+        yield trial
+
@@ -0,0 +1,131 @@
+import logging
+import os
+import shutil
+import tarfile
+import tempfile
+
+from protopt.database import CLUSTER_NAME
+
+
+logger = logging.getLogger()
+
+# Checkpoints up to this size in MB are uploaded to GridFS when their trial is
+# interrupted, so that it can resume on any cluster. The upload happens after
+# the script stopped, within the grace period of the scheduler. 0 disables the
+# migration.
+MIGRATION_SIZE = float(os.environ.get("PROTOPT_CHECKPOINT_MIGRATION_SIZE", 0))
+
+MB = 2. ** 20
+
+
+def get_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+
+    size = 0
+    for dir_path, _, file_names in os.walk(path):
+        for file_name in file_names:
+            try:
+                size += os.path.getsize(os.path.join(dir_path, file_name))
+            except OSError:
+                # Removed in between
+                continue
+
+    return size
+
+
+def get_trial_dir(path, trial_id):
+    # Returns path if it only holds the checkpoints of the trial, see
+    # Trial._run(). Trials of old experiments share their save_path, it is
+    # never measured, archived nor replaced.
+    path = os.path.normpath(path)
+    if os.path.basename(path) != str(trial_id):
+        return None
+
+    return path
+
+
+def get_location(checkpoint, path, trial_id):
+    # Where the checkpoint lives, recorded in info.checkpoint of the run and
+    # used to filter claims, see protopt.database.get_claimable_query(). The
+    # size is None for shared save_paths.
+    trial_dir = get_trial_dir(path, trial_id)
+    location = dict(checkpoint)
+    location.update(cluster=CLUSTER_NAME, path=path,
+                    size=get_size(trial_dir) if trial_dir else None)
+    return location
+
+
+def is_local(checkpoint):
+    return (checkpoint.get("cluster") == CLUSTER_NAME and
+            os.path.exists(checkpoint["path"]))
+
+
+class CheckpointStore(object):
+    # Moves the save_path of trials between clusters through the GridFS of
+    # the database, as gzipped tar archives.
+
+    def __init__(self, fs):
+        self.fs = fs
+
+    def upload(self, trial_id, checkpoint):
+        # Returns the location of the checkpoint with the id of the archive
+        # in artifact, or None if it is too large or shared with other
+        # trials to be migrated
+        path = get_trial_dir(checkpoint["path"], trial_id)
+        if (path is None or checkpoint.get("size") is None or
+                checkpoint["size"] > MIGRATION_SIZE * MB):
+            return None
+
+        logger.info("Uploading checkpoint of trial %s (%.1f MB)" %
+                    (str(trial_id), checkpoint["size"] / MB))
+        with tempfile.TemporaryFile() as f:
+            with tarfile.open(fileobj=f, mode="w:gz") as tar:
+                tar.add(path, arcname=".")
+            f.seek(0)
+            artifact = self.fs.put(
+                f, filename="checkpoint_%s.tar.gz" % str(trial_id),
+                metadata=dict(trial_id=trial_id, step=checkpoint.get("step")))
+
+        # Only the last checkpoint is kept
+        if checkpoint.get("artifact") is not None:
+            self.fs.delete(checkpoint["artifact"])
+
+        checkpoint = dict(checkpoint)
+        checkpoint["artifact"] = artifact
+        return checkpoint
+
+    def download(self, trial_id, checkpoint, path):
+        # Restores the archive into path, the directory of the trial, and
+        # returns the local location
+        trial_dir = get_trial_dir(path, trial_id)
+        if trial_dir is None:
+            raise ValueError("%s is not the directory of trial %s, not "
+                             "replacing it" % (path, str(trial_id)))
+        path = trial_dir
+
+        logger.info("Downloading checkpoint %s to %s" %
+                    (str(checkpoint["artifact"]), path))
+        tmp_path = "%s.download-%d" % (path, os.getpid())
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path)
+
+        with tempfile.TemporaryFile() as f:
+            shutil.copyfileobj(self.fs.get(checkpoint["artifact"]), f)
+            f.seek(0)
+            with tarfile.open(fileobj=f, mode="r:gz") as tar:
+                tar.extractall(tmp_path)
+
+        # An outdated copy left by a previous run on this cluster
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        os.rename(tmp_path, path)
+
+        return get_location(checkpoint, path, trial_id)
+
+    def discard(self, checkpoint):
+        # Removes the archive of a checkpoint superseded by a newer one
+        if checkpoint and checkpoint.get("artifact") is not None:
+            self.fs.delete(checkpoint["artifact"])
@@ -0,0 +1,105 @@
+import json
+import os
+import threading
+import time
+
+
+# Used by training scripts to report to the wrapper running them. Must only
+# depend on the standard library.
+
+# File descriptor of the metric channel opened by the wrapper
+METRICS_FD = "PROTOPT_METRICS_FD"
+# File in which the step of the last checkpoint is written
+CHECKPOINT_MARKER = "PROTOPT_CHECKPOINT_MARKER"
+
+
+class Reporter(object):
+    # Writes one JSON record per line on the metric channel. Does nothing when
+    # the script is not run by the wrapper.
+
+    def __init__(self, fd=None):
+        if fd is None and os.environ.get(METRICS_FD):
+            fd = int(os.environ[METRICS_FD])
+
+        self.fd = fd
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.fd is not None
+
+    def log_metric(self, name, value, step=None, timestamp=None):
+        self.log_metrics({name: value}, step, timestamp)
+
+    def log_metrics(self, metrics, step=None, timestamp=None):
+        if not self.enabled:
+            return
+
+        if timestamp is None:
+            timestamp = time.time()
+
+        lines = "".join(
+            json.dumps(dict(name=name, value=float(value), step=step,
+                            timestamp=timestamp)) + "\n"
+            for name, value in metrics.items())
+
+        # A single write per call so that records of several threads are not
+        # interleaved.
+        with self.lock:
+            try:
+                os.write(self.fd, lines.encode("utf-8"))
+            except OSError:
+                # The wrapper is gone, the script will be killed anyway
+                self.fd = None
+
+    def checkpoint_done(self, step):
+        # Tells the wrapper that the checkpoint of the given step is safely on
+        # disk, see protopt.wrapper.Preemption.
+        path = os.environ.get(CHECKPOINT_MARKER)
+        if path is None:
+            return
+
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write("%d\n" % step)
+        os.rename(tmp_path, path)
+
+
+_reporter = None
+
+# Set when the worker running a function forked by
+# protopt.wrapper.fork_fct_signature() is preempted
+_preempted = False
+
+
+def get_reporter():
+    global _reporter
+    if _reporter is None:
+        _reporter = Reporter()
+
+    return _reporter
+
+
+def log_metric(name, value, step=None, timestamp=None):
+    get_reporter().log_metric(name, value, step, timestamp)
+
+
+def log_metrics(metrics, step=None, timestamp=None):
+    get_reporter().log_metrics(metrics, step, timestamp)
+
+
+def checkpoint_done(step):
+    get_reporter().checkpoint_done(step)
+
+
+def preemption_requested():
+    # True once the wrapper asked the trial to checkpoint and stop, for
+    # functions run with protopt.wrapper.fork_fct_signature(). Scripts run as
+    # separate processes get the signal itself (SIGTERM by default). Either
+    # must then exit with a non-zero status, 0 means the trial is completed.
+    return _preempted
+
+
+def on_preemption(signum, frame):
+    global _preempted
+    _preempted = True
@@ -1,22 +1,187 @@
+import copy
+import datetime
 import logging
+import time
+import uuid
+
+import pymongo
 
 from sacred.observers import MongoObserver
 
 import smartdispatch.utils
 
 import protopt.status
-from protopt.utils import get_mongodb_url
+from protopt.utils import LostClaim, get_mongodb_url
 
 
 CLUSTER_NAME = smartdispatch.utils.detect_cluster()
 
 logger = logging.getLogger()
 
+# Runnable trials are claimed by decreasing priority, then by age. Queued
+# trials get a priority in (0, 1) from their rank in the acquisition order,
+# interrupted ones are raised to RESUME_PRIORITY to reuse their checkpoints.
+RESUME_PRIORITY = 1.
+PRIORITY_SORT = [("priority", pymongo.DESCENDING), ("_id", pymongo.ASCENDING)]
+
+
+# Fields of a run which only exist once it started
+STARTED_FIELDS = ["host", "start_time", "heartbeat", "stop_time",
+                  "lease_expiry", "claim", "captured_out", "fail_trace",
+                  "result"]
+
+
+def get_claimable_query(cluster=CLUSTER_NAME):
+    # Runnable trials which can start on the cluster: queued ones and
+    # interrupted ones whose checkpoint is on the cluster or was migrated to
+    # GridFS, see protopt.checkpoints. Trials interrupted before recording
+    # the location of their checkpoint fall back on the cluster they ran on.
+    return {
+        "status": {"$in": protopt.status.RUNNABLE},
+        "$or": [
+            {"status": {"$in": protopt.status.QUEUED}},
+            {"info.checkpoint.cluster": cluster},
+            {"info.checkpoint.artifact": {"$exists": True}},
+            {"info.checkpoint.cluster": {"$exists": False},
+             "host.cluster": {"$in": [cluster, None]}}]}
+
+
+def new_claim():
+    # Token fencing the writes of the worker which claimed a trial, see
+    # LeasedMongoObserver
+    return uuid.uuid4().hex
+
+
+class LeasedMongoObserver(MongoObserver):
+    # RUNNING trials hold a lease which every heartbeat renews. A trial whose
+    # lease expired was lost by its worker and can be reaped.
+    #
+    # A worker which was only late may still be running a reaped trial, and
+    # another one may have claimed it since. Every claim writes a new token
+    # in the run, and writes only go through if the run is still RUNNING with
+    # the token of this observer. Otherwise the observer is fenced and the
+    # wrapper aborts the script.
+
+    def __init__(self, *args, **kwargs):
+        self.lease_ttl = kwargs.pop("lease_ttl", 300)
+        super(LeasedMongoObserver, self).__init__(*args, **kwargs)
+        self.fenced = False
+        # Priority of the next queued run, see Trial.queue()
+        self.priority = None
+        # The run as it was before being claimed, restored if the trial is
+        # released, None for runs created by the claim. Set by the options of
+        # protopt.sacred_commandline_options.
+        self.claimed_from = None
+
+    def get_lease_expiry(self, now=None):
+        if now is None:
+            now = datetime.datetime.utcnow()
+        return now + datetime.timedelta(seconds=self.lease_ttl)
+
+    def started_event(self, *args, **kwargs):
+        # Observers are reused by the runs of a worker
+        self.fenced = False
+        return super(LeasedMongoObserver, self).started_event(*args, **kwargs)
+
+    def insert(self):
+        # Queued runs are inserted with their priority, they are claimable
+        # as soon as they exist
+        if self.priority is not None:
+            self.run_entry["priority"] = self.priority
+
+        return super(LeasedMongoObserver, self).insert()
+
+    def _get_claim_filter(self):
+        query = {"_id": self.run_entry["_id"]}
+        if self.run_entry.get("claim") is not None:
+            query.update(claim=self.run_entry["claim"], status="RUNNING")
+
+        return query
+
+    def _check_claim(self, matched_count):
+        if matched_count == 0 and self.run_entry.get("claim") is not None:
+            self.fenced = True
+
+        if self.fenced:
+            raise LostClaim("Trial %s was claimed by another worker, not "
+                            "saving it" % str(self.run_entry["_id"]))
+
+    def save(self):
+        if self.fenced:
+            self._check_claim(0)
+
+        try:
+            result = self.runs.replace_one(self._get_claim_filter(),
+                                           self.run_entry)
+        except pymongo.errors.AutoReconnect:
+            # Saved again at the next heartbeat
+            return
+
+        self._check_claim(result.matched_count)
+
+    def final_save(self, attempts=10):
+        if self.fenced:
+            self._check_claim(0)
+
+        # Runs which were never claimed are recreated if they disappeared
+        upsert = self.run_entry.get("claim") is None
+        for i in range(attempts):
+            try:
+                result = self.runs.replace_one(self._get_claim_filter(),
+                                               self.run_entry, upsert=upsert)
+                break
+            except pymongo.errors.AutoReconnect:
+                if i == attempts - 1:
+                    raise
+                time.sleep(1)
+
+        self._check_claim(result.matched_count)
+
+    def log_metrics(self, *args, **kwargs):
+        # Metrics are written elsewhere than the run, check the claim first
+        if self.run_entry is not None and self.run_entry.get("claim"):
+            row = self.runs.find_one(self._get_claim_filter(), {"_id": 1})
+            self._check_claim(int(row is not None))
+
+        return super(LeasedMongoObserver, self).log_metrics(*args, **kwargs)
+
+    def heartbeat_event(self, info, captured_out, beat_time, *args, **kwargs):
+        if self.run_entry is not None:
+            self.run_entry["lease_expiry"] = self.get_lease_expiry(beat_time)
+
+        return super(LeasedMongoObserver, self).heartbeat_event(
+            info, captured_out, beat_time, *args, **kwargs)
+
+    def interrupted_event(self, interrupt_time, status, *args, **kwargs):
+        if self.run_entry is not None and status == protopt.status.RELEASED:
+            return self._release()
+
+        if self.run_entry is not None:
+            self.run_entry["priority"] = max(
+                self.run_entry.get("priority", 0.), RESUME_PRIORITY)
+
+        return super(LeasedMongoObserver, self).interrupted_event(
+            interrupt_time, status, *args, **kwargs)
+
+    def _release(self):
+        # The script never started, the trial keeps its status and priority
+        # instead of being resumed from a checkpoint which does not exist
+        entry = self.claimed_from
+        if entry is None:
+            entry = dict((key, value) for key, value in self.run_entry.items()
+                         if key not in STARTED_FIELDS)
+            entry["status"] = protopt.status.QUEUED[0]
+
+        result = self.runs.replace_one(self._get_claim_filter(), entry)
+        self._check_claim(result.matched_count)
+        logger.info("Released trial %s" % str(self.run_entry["_id"]))
+
 
 class Database(object):
 
     def __init__(self, name, collection, host_names, ports, user_name, password, ssl=False,
-                 ssl_ca_file=None, replica_set=None, auth_source=None):
+                 ssl_ca_file=None, replica_set=None, auth_source=None,
+                 trial_lease_ttl=300):
 
         self.name = name
         self.collection = collection
@@ -28,18 +193,38 @@ class Database(object):
         self.ssl_ca_file = ssl_ca_file
         self.replica_set = replica_set
         self.auth_source = auth_source
+        self.trial_lease_ttl = trial_lease_ttl
 
         self.mongo_observer = self._build_mongo_observer()
         self.runs = self.mongo_observer.runs
         self.metrics = self.mongo_observer.metrics
         self.fs = self.mongo_observer.fs
+        self.leases = self.runs.database[self.collection + "_leases"]
+
+        self.runs.create_index([("status", pymongo.ASCENDING),
+                                ("lease_expiry", pymongo.ASCENDING)])
+        self.runs.create_index([("status", pymongo.ASCENDING)] +
+                               PRIORITY_SORT)
+        self.runs.create_index([("info.checkpoint.cluster", pymongo.ASCENDING),
+                                ("status", pymongo.ASCENDING)])
+        # For the usage of the experiments served by a worker
+        self.runs.create_index([("experiment.name", pymongo.ASCENDING),
+                                ("start_time", pymongo.ASCENDING)])
+
+    def clone(self):
+        # Shares the connection but has its own observer, which holds the
+        # state of the run being executed.
+        database = copy.copy(self)
+        database.mongo_observer = self.build_mongo_observer()
+        return database
 
     def build_mongo_observer(self):
         logger.debug("Reusing database")
-        return MongoObserver(runs_collection=self.mongo_observer.runs,
-                             fs=self.mongo_observer.fs,
-                             metrics_collection=self.mongo_observer.metrics,
-                             overwrite=None)
+        return LeasedMongoObserver(
+            runs_collection=self.mongo_observer.runs,
+            fs=self.mongo_observer.fs,
+            metrics_collection=self.mongo_observer.metrics,
+            overwrite=None, lease_ttl=self.trial_lease_ttl)
 
     def _build_mongo_observer(self):
         logger.debug("Opening database %s with collection %s" %
@@ -71,9 +256,65 @@ class Database(object):
             url=mongo_url, db_name=self.name,
             collection=self.collection, **options)
 
-        return mongodb_observer
+        return LeasedMongoObserver(
+            runs_collection=mongodb_observer.runs,
+            fs=mongodb_observer.fs,
+            metrics_collection=mongodb_observer.metrics,
+            overwrite=None, lease_ttl=self.trial_lease_ttl)
 
-    def query(self, query=None, projection=None):
+    def reap_expired_trials(self):
+        # Single indexed update, cheap enough to be called by every worker
+        result = self.runs.update_many(
+            {
+                "status": "RUNNING",
+                "lease_expiry": {"$lt": datetime.datetime.utcnow()}
+            },
+            {
+                "$set": {"status": "INTERRUPTED"},
+                "$unset": {"lease_expiry": ""},
+                "$max": {"priority": RESUME_PRIORITY}
+            })
+
+        if result.modified_count > 0:
+            logger.info("%d trials with an expired lease set to INTERRUPTED" %
+                        result.modified_count)
+
+        return result.modified_count
+
+    def interrupt_trial(self, trial_id, claim=None):
+        # For a trial whose worker could not wind down, so that it does not
+        # wait for the expiry of its lease to be resumed
+        query = {"_id": trial_id, "status": "RUNNING"}
+        if claim is not None:
+            query["claim"] = claim
+        result = self.runs.update_one(
+            query,
+            {
+                "$set": {"status": "INTERRUPTED"},
+                "$unset": {"lease_expiry": ""},
+                "$max": {"priority": RESUME_PRIORITY}
+            })
+
+        return result.modified_count
+
+    def get_usage(self, experiment_name):
+        # Wall time in seconds consumed by the trials of the experiment. Runs
+        # do not record how many slots they hold, each trial counts as one.
+        # Trials still running count up to their last heartbeat.
+        result = list(self.runs.aggregate([
+            {"$match": {"experiment.name": experiment_name,
+                        "start_time": {"$exists": True}}},
+            {"$project": {"duration": {"$subtract": [
+                {"$ifNull": ["$stop_time", "$heartbeat"]}, "$start_time"]}}},
+            {"$group": {"_id": None, "total": {"$sum": "$duration"}}}]))
+
+        if not result or result[0]["total"] is None:
+            return 0.
+
+        # Differences of dates are in milliseconds
+        return result[0]["total"] / 1000.
+
+    def query(self, query=None, projection=None, sort=None):
         if query is None:
             query = {}
 
@@ -81,45 +322,20 @@ class Database(object):
             projection = {"config": 1, "result": 1, "status": 1, "metrics": 1}
 
         rows = self.runs.find(
-            query, projection)
+            query, projection, sort=sort)
 
         return rows
 
     def find_job(self):
         logger.info("Looking for a new job")
-        rows = self.runs.find({
-            "status": {
-                "$in": protopt.status.RUNNABLE
-            },
-            "$or": [
-                {
-                    "info.cluster": {
-                        "$exists": False
-                    }
-                },
-                {
-                    "info.cluster": {
-                        "$eq": CLUSTER_NAME
-                    }
-                }
-            ]},
-            {"id": 1, "config": 1})
-
-        logger.debug("Counting jobs")
-        count = rows.count()
-        logger.info("%d jobs available" % count)
-        # if count > 1:
-        #    random_index = numpy.random.randint(count)
-        if count >= 1:
-            random_index = 0
-        else:
-            return None
+        job = self.runs.find_one(
+            get_claimable_query(),
+            {"id": 1, "config": 1}, sort=PRIORITY_SORT)
+
+        if job is not None:
+            logger.debug("Selected id: %d" % job["_id"])
 
-        random_job = rows[random_index]
-        selected_id = random_job["_id"]
-        logger.debug("Selected id: %d (@index %d)" %
-                     (selected_id, random_index))
-        return random_job
+        return job
 
     def select_random_config(self, space):
         row = self.find_job()
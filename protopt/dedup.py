@@ -0,0 +1,117 @@
+import logging
+import math
+
+import numpy
+
+from scipy.spatial import cKDTree
+
+from skopt.space import Categorical, Integer as SkoptInteger
+
+from protopt.space import Integer, RTOL
+
+
+logger = logging.getLogger()
+
+
+class NeighbourIndex(object):
+    # Points are encoded so that two of them are duplicates if and only if
+    # their Chebyshev distance is at most 1:
+    #   - reals are equal up to the relative tolerance of
+    #     get_tolerance_interval(), which the database queries use too. Each
+    #     one takes two columns, its sign and the log of its magnitude,
+    #   - integers and categories must be exactly equal. Values outside of
+    #     the categories each get their own code.
+
+    def __init__(self, dimensions, rtol=RTOL):
+        self.dimensions = list(dimensions)
+        self.rtol = rtol
+        self.tree = None
+        # Codes of values outside of the categories, per dimension
+        self.unknown = [{} for _ in self.dimensions]
+
+    @property
+    def n_columns(self):
+        return sum(len(self._get_columns(dimension))
+                   for dimension in self.dimensions)
+
+    @staticmethod
+    def _get_columns(dimension):
+        if (isinstance(dimension, (Categorical, Integer, SkoptInteger))):
+            return ["value"]
+
+        return ["sign", "magnitude"]
+
+    def _encode_category(self, i, categories, value):
+        if value in categories:
+            return categories.index(value)
+
+        unknown = self.unknown[i]
+        if value not in unknown:
+            unknown[value] = -1 - len(unknown)
+        return unknown[value]
+
+    def _encode_dimension(self, i, dimension, values):
+        if isinstance(dimension, Categorical):
+            categories = list(dimension.categories)
+            return [2. * numpy.array(
+                [self._encode_category(i, categories, value)
+                 for value in values], dtype=float)]
+        elif isinstance(dimension, (Integer, SkoptInteger)):
+            return [2. * numpy.asarray(values, dtype=float)]
+
+        # a and b are the same iff they have the same sign and
+        # |log|a| - log|b|| <= log(1 + rtol). Zero has a sign of its own.
+        values = numpy.asarray(values, dtype=float)
+        sign = numpy.sign(values)
+        magnitude = numpy.zeros(len(values))
+        nonzero = sign != 0
+        magnitude[nonzero] = (numpy.log(numpy.abs(values[nonzero])) /
+                              math.log1p(self.rtol))
+
+        return [2. * sign, magnitude]
+
+    def encode(self, rows):
+        rows = list(rows)
+        if not rows:
+            return numpy.zeros((0, self.n_columns))
+
+        columns = []
+        for i, dimension in enumerate(self.dimensions):
+            columns += self._encode_dimension(
+                i, dimension, [row[i] for row in rows])
+
+        return numpy.array(columns).T
+
+    def fit(self, rows):
+        return self.fit_encoded(self.encode(rows))
+
+    def fit_encoded(self, points):
+        self.tree = cKDTree(points) if len(points) else None
+        return self
+
+    def filter(self, candidates):
+        candidates = [tuple(candidate) for candidate in candidates]
+        points = self.encode(candidates)
+
+        if self.tree is not None and len(points):
+            neighbours = self.tree.query_ball_point(points, r=1., p=numpy.inf)
+        else:
+            neighbours = [[] for _ in candidates]
+
+        unique_candidates = []
+        unique_points = []
+        for candidate, point, point_neighbours in zip(candidates, points,
+                                                      neighbours):
+            if point_neighbours:
+                continue
+
+            # Candidates are few, compare them by brute force
+            if unique_points and numpy.min(numpy.max(
+                    numpy.abs(numpy.array(unique_points) - point),
+                    axis=1)) <= 1.:
+                continue
+
+            unique_candidates.append(candidate)
+            unique_points.append(point)
+
+        return unique_candidates
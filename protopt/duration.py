@@ -0,0 +1,133 @@
+import datetime
+import logging
+
+import numpy
+
+from sklearn.ensemble import ExtraTreesRegressor
+
+
+logger = logging.getLogger()
+
+
+def _to_seconds(timestamp):
+    if isinstance(timestamp, datetime.datetime):
+        delta = timestamp - datetime.datetime(1970, 1, 1)
+        return delta.total_seconds()
+
+    return float(timestamp)
+
+
+def get_runtime(row):
+    # Seconds taken by a trial from its start to its end
+    if row.get("start_time") is None or row.get("stop_time") is None:
+        return None
+
+    return _to_seconds(row["stop_time"]) - _to_seconds(row["start_time"])
+
+
+class DurationModel(object):
+    # Estimates the time a trial needs to reach its next checkpoint from the
+    # timestamps of its metric. Scripts are expected to checkpoint at every
+    # step of the metric (usually an epoch). Trials which never logged the
+    # metric take the median of completed trials.
+
+    def __init__(self, metric_name):
+        self.metric_name = metric_name
+        self.startup = None
+        self.step_duration = None
+
+    def fit(self, rows):
+        startups = []
+        step_durations = []
+        for row in rows:
+            startup = self.get_startup(row)
+            if startup is not None:
+                startups.append(startup)
+
+            step_duration = self.get_step_duration(row)
+            if step_duration is not None:
+                step_durations.append(step_duration)
+
+        if startups:
+            self.startup = float(numpy.median(startups))
+        if step_durations:
+            self.step_duration = float(numpy.median(step_durations))
+
+        return self
+
+    def _get_metric(self, row):
+        metric = row.get("metrics", {}).get(self.metric_name)
+        if not metric or not metric.get("timestamps"):
+            return None, None
+
+        return (metric["steps"],
+                [_to_seconds(timestamp) for timestamp in metric["timestamps"]])
+
+    def get_startup(self, row):
+        # Time between the start of the trial and its first step
+        steps, timestamps = self._get_metric(row)
+        if steps is None or row.get("start_time") is None:
+            return None
+
+        startup = timestamps[0] - _to_seconds(row["start_time"])
+        return startup if startup >= 0 else None
+
+    def get_step_duration(self, row):
+        steps, timestamps = self._get_metric(row)
+        if steps is None or len(steps) < 2 or steps[-1] <= steps[0]:
+            return None
+
+        return (timestamps[-1] - timestamps[0]) / float(steps[-1] - steps[0])
+
+    def estimate(self, row):
+        # Seconds to the next checkpoint, None if there is nothing to rely on
+        step_duration = self.get_step_duration(row)
+        if step_duration is None:
+            step_duration = self.step_duration
+
+        if step_duration is None:
+            return None
+
+        return (self.startup or 0.) + step_duration
+
+
+class RuntimeModel(object):
+    # Predicts the runtime of configurations from the completed trials. Works
+    # in the transformed space of the optimizer, see TrialMatrix.
+
+    def __init__(self, space, min_trials=5):
+        self.space = space
+        self.min_trials = min_trials
+        self.regressor = None
+        self.n_trials = 0
+
+    @property
+    def fitted(self):
+        return self.regressor is not None
+
+    def fit(self, transformed, runtime):
+        known = ~numpy.isnan(runtime) & (runtime > 0)
+        if known.sum() == self.n_trials and self.fitted:
+            return self
+
+        self.n_trials = int(known.sum())
+        if self.n_trials < self.min_trials:
+            logger.info("Not enough completed trials (%d) to train the "
+                        "runtime model" % self.n_trials)
+            self.regressor = None
+            return self
+
+        logger.info("Training runtime model on %d trials" % self.n_trials)
+        # Runtimes span orders of magnitude, errors are relative
+        self.regressor = ExtraTreesRegressor(n_estimators=100,
+                                             min_samples_leaf=2)
+        self.regressor.fit(transformed[known], numpy.log(runtime[known]))
+
+        return self
+
+    def predict(self, rows):
+        # Seconds, all ones when not fitted
+        if not self.fitted:
+            return numpy.ones(len(rows))
+
+        return numpy.exp(self.regressor.predict(self.space.transform(rows)))
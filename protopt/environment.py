@@ -0,0 +1,280 @@
+# Provisions the Python environment of the trials on the nodes.
+#
+# An environment is identified by the hash of everything it is built from:
+# the wheels, the setup scripts and the interpreter. It is built once into a
+# shared cache as an archive and unpacked once per node. Packages are
+# installed with pip --target so that the result can be moved anywhere and is
+# activated with PYTHONPATH, see bin/opt-run.
+#
+# Runs before the environment exists, it must only depend on the standard
+# library.
+import argparse
+import contextlib
+import errno
+import hashlib
+import logging
+import os
+import platform
+import shlex
+import shutil
+import subprocess
+import sys
+import tarfile
+import threading
+import time
+
+from protopt.filelock import FileLock
+
+
+logger = logging.getLogger()
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.expanduser("~"), ".cache", "protopt", "environments")
+
+# Seconds between two touches of the claim file by the job building an
+# environment, and seconds without one after which the build is considered
+# dead
+BUILD_HEARTBEAT = 60
+BUILD_TIMEOUT = 600
+# Seconds to wait for another process of the node unpacking the environment
+UNPACK_TIMEOUT = 1800
+
+CHUNK_SIZE = 2 ** 20
+
+
+def _makedirs(path):
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            # Created concurrently
+            if not os.path.isdir(path):
+                raise
+
+
+def _update_with_file(digest, path):
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+
+
+@contextlib.contextmanager
+def _heartbeat(path, interval=BUILD_HEARTBEAT):
+    # Touches path until the block exits, so that other jobs keep waiting
+    # however long the build takes
+    stop = threading.Event()
+
+    def touch():
+        while not stop.wait(interval):
+            try:
+                os.utime(path, None)
+            except OSError:
+                # Taken over by another job, the build goes on anyway
+                pass
+
+    thread = threading.Thread(target=touch)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+class Provisioner(object):
+    def __init__(self, wheel_dir, packages, setup_scripts=(), depends_on=(),
+                 cache_dir=DEFAULT_CACHE_DIR, local_root=None):
+        self.wheel_dir = wheel_dir
+        self.packages = list(packages)
+        # Shell commands, run with pip installing into the environment
+        self.setup_scripts = list(setup_scripts)
+        # Other files which change the content of the environment
+        self.depends_on = list(depends_on)
+        self.cache_dir = cache_dir
+        if local_root is None:
+            local_root = os.path.join(
+                os.environ.get("SLURM_TMPDIR", "/tmp"), "environments")
+        self.local_root = local_root
+
+    def get_hash(self):
+        digest = hashlib.sha1()
+        digest.update(sys.version.encode("utf-8"))
+        digest.update(platform.platform().encode("utf-8"))
+
+        for package in self.packages:
+            digest.update(package.encode("utf-8"))
+
+        files = list(self.depends_on)
+        for command in self.setup_scripts:
+            digest.update(command.encode("utf-8"))
+            script = shlex.split(command)[0]
+            if os.path.isfile(script):
+                files.append(script)
+
+        for path in files:
+            digest.update(path.encode("utf-8"))
+            if os.path.isfile(path):
+                _update_with_file(digest, path)
+
+        for name in sorted(os.listdir(self.wheel_dir)):
+            path = os.path.join(self.wheel_dir, name)
+            if os.path.isfile(path):
+                digest.update(name.encode("utf-8"))
+                _update_with_file(digest, path)
+
+        return digest.hexdigest()
+
+    def provision(self):
+        # Returns the path of the environment on this node
+        env_hash = self.get_hash()
+        path = os.path.join(self.local_root, env_hash)
+
+        _makedirs(self.local_root)
+        with FileLock(path + ".lock", timeout=UNPACK_TIMEOUT):
+            if os.path.isdir(path):
+                logger.info("Environment %s already on this node" % env_hash)
+                return path
+
+            archive = self._get_archive(env_hash)
+
+            logger.info("Unpacking environment %s" % env_hash)
+            tmp_path = "%s.tmp-%d" % (path, os.getpid())
+            if os.path.isdir(tmp_path):
+                shutil.rmtree(tmp_path)
+            with tarfile.open(archive, "r:gz") as tar:
+                tar.extractall(tmp_path)
+            # Only complete environments have the final name
+            os.rename(tmp_path, path)
+
+        return path
+
+    def _get_archive(self, env_hash):
+        # Archives are published with an atomic rename, a job which finds one
+        # can use it right away. The claim file makes other jobs wait for the
+        # one building instead of building the same environment.
+        _makedirs(self.cache_dir)
+        archive = os.path.join(self.cache_dir, env_hash + ".tar.gz")
+        claim = os.path.join(self.cache_dir, env_hash + ".building")
+
+        while not os.path.exists(archive):
+            try:
+                fd = os.open(claim, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except OSError:
+                try:
+                    age = time.time() - os.path.getmtime(claim)
+                except OSError:
+                    # Released in between
+                    continue
+
+                if age > BUILD_TIMEOUT:
+                    logger.warning("Build of environment %s looks dead, "
+                                   "taking it over" % env_hash)
+                    try:
+                        os.remove(claim)
+                    except OSError:
+                        pass
+                else:
+                    logger.info("Waiting for another job building "
+                                "environment %s" % env_hash)
+                    time.sleep(10)
+                continue
+
+            os.close(fd)
+            try:
+                with _heartbeat(claim):
+                    self._build(archive)
+            finally:
+                # Another job may have taken over a build it thought dead
+                try:
+                    os.remove(claim)
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+
+        return archive
+
+    def _build(self, archive):
+        build_path = "%s.build-%s-%d" % (archive, platform.node(),
+                                         os.getpid())
+        logger.info("Building environment in %s" % build_path)
+        start_time = time.time()
+
+        env = dict(os.environ)
+        env["PIP_TARGET"] = build_path
+        env["PIP_NO_INDEX"] = "1"
+        env["PIP_FIND_LINKS"] = self.wheel_dir
+
+        try:
+            for command in self.setup_scripts:
+                subprocess.check_call(["bash"] + shlex.split(command),
+                                      env=env, stdout=sys.stderr)
+
+            if self.packages:
+                subprocess.check_call(
+                    [sys.executable, "-m", "pip", "install"] + self.packages,
+                    env=env, stdout=sys.stderr)
+
+            tmp_archive = build_path + ".tar.gz"
+            with tarfile.open(tmp_archive, "w:gz") as tar:
+                tar.add(build_path, arcname=".")
+            os.rename(tmp_archive, archive)
+        finally:
+            if os.path.isdir(build_path):
+                shutil.rmtree(build_path)
+
+        logger.info("Environment built in %.1f seconds" %
+                    (time.time() - start_time))
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description="Provision the environment of the trials on this node "
+                    "and print its path.")
+
+    parser.add_argument(
+        "packages", nargs="*",
+        help="Packages to install from the wheel house.")
+
+    parser.add_argument(
+        "--wheel-dir", required=True,
+        help="Wheel house, the only source of packages.")
+
+    parser.add_argument(
+        "--setup-script", action="append", default=[],
+        help=("Shell command run with pip installing into the environment, "
+              "for instance install_requirements.sh. Can be repeated."))
+
+    parser.add_argument(
+        "--depends-on", action="append", default=[],
+        help=("Other file whose content changes the environment. Can be "
+              "repeated."))
+
+    parser.add_argument(
+        "--cache-dir", default=DEFAULT_CACHE_DIR,
+        help="Shared directory of built environments. Default is %s" %
+             DEFAULT_CACHE_DIR)
+
+    parser.add_argument(
+        "--local-root",
+        help=("Node-local directory of unpacked environments. Default is "
+              "$SLURM_TMPDIR/environments."))
+
+    return parser
+
+
+def main(argv=None):
+    opt = build_parser().parse_args(argv)
+
+    # stdout is only for the path of the environment
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+
+    provisioner = Provisioner(
+        opt.wheel_dir, opt.packages, setup_scripts=opt.setup_script,
+        depends_on=opt.depends_on, cache_dir=opt.cache_dir,
+        local_root=opt.local_root)
+    print(provisioner.provision())
+
+
+if __name__ == "__main__":
+    main()
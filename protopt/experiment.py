@@ -1,7 +1,7 @@
 import itertools
 import logging
 import re
-from random import shuffle
+import time
 
 import numpy
 
@@ -10,6 +10,10 @@ import smartdispatch.utils
 from sacred import host_info_getter
 
 import protopt.status
+from protopt.database import PRIORITY_SORT, get_claimable_query
+from protopt.duration import DurationModel
+from protopt.lease import Lease
+from protopt.matrix import TrialMatrix
 from protopt.trials import Trial
 
 
@@ -17,6 +21,9 @@ logger = logging.getLogger()
 
 CLUSTER_NAME = smartdispatch.utils.detect_cluster()
 
+# Seconds after which the duration model is fitted again on completed trials
+DURATION_MODEL_TTL = 600
+
 
 @host_info_getter
 def cluster():
@@ -47,7 +54,8 @@ def walltime_to_seconds(walltime):
 class Experiment(object):
 
     def __init__(self, name, dir_path, fct, validate_on, space, optimizer,
-                 database, default_result=10000.):
+                 database, default_result=10000., lease_ttl=600,
+                 lease_poll_interval=10, sources=None, source_weight=0.5):
         self.name = name
         self.dir_path = dir_path
         self.fct = fct
@@ -56,7 +64,40 @@ class Experiment(object):
         self.optimizer = optimizer
         self.database = database
         self.excluded_trials = set()
+        self.matrix = None
+        self.duration_model = None
+        self.duration_model_time = 0
+        # Sacred's capture mode, None for its default
+        self.capture_mode = None
         self.default_result = default_result
+        # Only one worker at a time fits the optimizer for this experiment
+        self.lease = Lease(database.leases, name, ttl=lease_ttl)
+        self.lease_poll_interval = lease_poll_interval
+        # Related experiments whose completed trials are used to warm-start
+        # the optimizer
+        self.sources = sources if sources is not None else []
+        self.source_weight = source_weight
+
+    def clone(self, space=None):
+        # Experiment for another worker of the same process. The optimizer and
+        # the trial matrix are shared, sampling is serialized by the lease.
+        if space is None:
+            space = self.space
+
+        if self.matrix is None:
+            self.matrix = TrialMatrix(self.space)
+
+        experiment = Experiment(
+            name=self.name, dir_path=self.dir_path, fct=self.fct,
+            validate_on=self.validate_on, space=space,
+            optimizer=self.optimizer, database=self.database.clone(),
+            default_result=self.default_result, lease_ttl=self.lease.ttl,
+            lease_poll_interval=self.lease_poll_interval,
+            sources=self.sources, source_weight=self.source_weight)
+        experiment.matrix = self.matrix
+        experiment.capture_mode = self.capture_mode
+
+        return experiment
 
     def _build_trial(self, row):
         config = row["config"]
@@ -209,7 +250,7 @@ class Experiment(object):
         # return result
 
     def get_trials(self, query=None, projection=None, evaluations=False,
-                   iterator=None):
+                   iterator=None, sort=None):
 
         if iterator is None:
             iterator = iter
@@ -224,11 +265,13 @@ class Experiment(object):
         # if not evaluations:
         #     query["config.validate"] = {"$eq": True}
 
-        query.update(self.get_query_for_profile())
+        # Profiles, bounds and categories are filtered by the database
+        query.update(self.space.get_query())
+        requires_validation = self.space.requires_validation()
 
-        rows = self.database.query(query, projection)
+        rows = self.database.query(query, projection, sort)
         for row in iterator(rows):
-            if not self.space.validate(row["config"]):
+            if requires_validation and not self.space.validate(row["config"]):
                 # raise RuntimeError("Invalid row %d" % row["_id"])
                 logger.debug("Invalid row %d" % row["_id"])
                 continue
@@ -238,38 +281,15 @@ class Experiment(object):
             # if evaluations or self.space.validate(row["config"]):
             #    yield self._build_trial(row)
 
-    def get_query_for_profile(self):
-        query_for_profile = dict()
-        for profile_name, profile in self.space.iter_profiles():
-            for hp_name, hp_value in profile.items():
-                query_for_profile["config.%s" % hp_name] = {"$eq": hp_value}
-
-        return query_for_profile
-
     def get_runnable_trials(self, force_new=True):
-        # Either the trial is queued or was interrupted on the same cluster
-        trials = self.get_trials({
-            "status": {
-                "$in": protopt.status.RUNNABLE
-            }}, {
-            "config": 1, "status": 1})
-
-        #     TODO: Find why this doesn't work.
-        #     "$or": [
-        #         {
-        #             "status": {
-        #                 "$in": status.QUEUED
-        #             },
-        #         },
-        #         {
-        #             "status": {
-        #                 "$in": status.INTERRUPTED
-        #             },
-        #             "host.cluster_name": {
-        #                 "$eq": CLUSTER_NAME
-        #             }
-        #         }
-        #     ]})
+        # Either the trial is queued or its checkpoint can be reached from
+        # this cluster. Most valuable first, interrupted trials resume from a
+        # checkpoint.
+        trials = self.get_trials(get_claimable_query(), {
+            "config": 1, "status": 1, "start_time": 1, "host.cluster": 1,
+            "info.checkpoint": 1,
+            "metrics.%s" % self.get_validation_metric(): 1},
+            sort=PRIORITY_SORT)
 
         # Avoid the need of creating a list by "copying" the generator
         trials = (trial for trial in trials
@@ -282,42 +302,116 @@ class Experiment(object):
 
         return trials
 
+    def count_runnable_trials(self):
+        return sum(1 for _ in self.get_runnable_trials(force_new=False))
+
+    def get_duration_model(self):
+        if (self.duration_model is None or
+                time.time() - self.duration_model_time > DURATION_MODEL_TTL):
+            metric_name = self.get_validation_metric()
+            rows = (trial.row for trial in self.get_completed_trials(
+                projection={"config": 1, "start_time": 1,
+                            "metrics.%s" % metric_name: 1}))
+            self.duration_model = DurationModel(metric_name).fit(rows)
+            self.duration_model_time = time.time()
+
+        return self.duration_model
+
     def exclude(self, trial):
         self.excluded_trials.add(trial.id)
 
     def get_completed_trials(self, **kwargs):
         return self.get_trials({"status": {"$in": protopt.status.COMPLETED}}, **kwargs)
 
-    def create_new_trials(self):
-        logger.info("Creating new trials")
-
-        strategy = self.optimizer.strategy
-
-        x = []
-        y = []
-        for trial in self.get_trials({}):
-            x.append(self.space.dict_to_list(trial.setting))
-
-            try:
-                y.append(trial.result[1])
-            except:
-                # We should be able to get the result if status is COMPLETED
-                assert trial.status != "COMPLETED"
-                if strategy == "cl_min":
-                    y_lie = numpy.min(y) if y else 0.0
-                elif strategy == "cl_mean":
-                    y_lie = numpy.mean(y) if y else 0.0
-                else:
-                    y_lie = numpy.max(y) if y else 0.0
-
-                y.append(y_lie)
+    def create_new_trials(self, n_runnable=0):
+        while not self.lease.acquire():
+            logger.info("Another worker is sampling new candidates. "
+                        "Waiting for it.")
+            time.sleep(self.lease_poll_interval)
+            runnable_trials = list(self.get_runnable_trials(force_new=False))
+            if len(runnable_trials) > n_runnable:
+                return runnable_trials
 
-        x = self.optimizer.get_new_candidates(x, y)
-        return self.register_settings(x)
+        try:
+            return self._create_new_trials(n_runnable)
+        finally:
+            self.lease.release()
 
-    def register_settings(self, settings):
+    def _create_new_trials(self, n_runnable):
+        logger.info("Creating new trials")
 
-        shuffle(settings)
+        if self.matrix is None:
+            self.matrix = TrialMatrix(self.space)
+        # INVALID and FAILED trials are kept out of the regression, the
+        # optimizer learns to avoid them with a feasibility model instead.
+        self.matrix.update(self.get_trials({}, {
+            "config": 1, "result": 1, "status": 1, "metrics": 1,
+            "info.failure": 1, "start_time": 1, "stop_time": 1}))
+
+        prior = self.get_source_observations(self.matrix)
+
+        x = self.optimizer.get_new_candidates(self.matrix, prior=prior)
+        return self.register_settings(x, n_runnable=n_runnable)
+
+    def get_source_observations(self, matrix):
+        if not self.sources:
+            return [], []
+
+        past_candidates = set(tuple(row) for row in matrix.get_points())
+
+        x_source = []
+        y_source = []
+        for source in self.sources:
+            n_mapped = 0
+            for trial in source.get_completed_trials():
+                # Dimensions missing in the source take their default value
+                # and hyper-parameters pinned by our profiles are not part of
+                # the space, so they are fixed by construction.
+                row = self.space.dict_to_list(trial.setting)
+                if (tuple(row) in past_candidates or
+                        not self.space.contains(row)):
+                    continue
+
+                try:
+                    result = trial.result[1]
+                except (KeyError, ValueError) as e:
+                    logger.debug("Ignoring source trial %s: %s" %
+                                 (str(trial.id), str(e)))
+                    continue
+
+                x_source.append(row)
+                y_source.append(result)
+                n_mapped += 1
+
+            logger.info("Mapped %d completed trials from source experiment %s" %
+                        (n_mapped, source.name))
+
+        if not y_source:
+            return [], []
+
+        # Down-weight source observations by shrinking them towards the mean
+        # of our own results. Their ranking is kept but their spread is reduced
+        # so that our own observations dominate as soon as there are some.
+        source_mean = numpy.mean(y_source)
+        y = matrix.get_known_objectives()
+        target_mean = numpy.mean(y) if len(y) else source_mean
+        y_source = [float(target_mean + self.source_weight * (value - source_mean))
+                    for value in y_source]
+
+        return x_source, y_source
+
+    def register_settings(self, settings, n_runnable=0):
+
+        # Candidates come in acquisition order. Cost-aware optimizers favor
+        # the cheapest, which give results sooner. Their runtime model was
+        # fitted on the same matrix while sampling, it is not trained again.
+        runtime_model = None
+        if (getattr(self.optimizer, "cost_aware", False) and
+                self.matrix is not None):
+            runtime_model = self.matrix.get_runtime_model()
+        if runtime_model is not None and runtime_model.fitted:
+            runtime = runtime_model.predict(settings)
+            settings = [settings[i] for i in numpy.argsort(runtime)]
 
         # TODO might be better to do a direct count rather than iterating over
         # trials through the interface
@@ -326,7 +420,10 @@ class Experiment(object):
         #  method was called)
         runnable_trials = list(self.get_runnable_trials(force_new=False))
 
-        if len(runnable_trials) > 0:
+        # n_runnable is the number of runnable trials seen by the caller before
+        # sampling. It is always 0 for workers but the generator refills the
+        # queue before it is empty.
+        if len(runnable_trials) > n_runnable:
             logger.info(
                 "Some trials changed of status and became runnable during the "
                 "sampling of new ones. The new ones are now discarded.")
@@ -334,16 +431,27 @@ class Experiment(object):
 
         trials = []
         for i, hp_list in enumerate(settings):
+            # Fencing: do not register anything if our lease expired while
+            # sampling, another worker is now responsible for it.
+            if not self.lease.renew():
+                logger.info(
+                    "Lost the lease on candidate sampling. Stop registering "
+                    "new trials.")
+                return list(self.get_runnable_trials(force_new=False))
+
             setting = self.space.list_to_dict(hp_list)
             trial = self._build_trial({'config': setting})
-            trial.queue()
+            # Candidates are registered by decreasing value, below
+            # RESUME_PRIORITY
+            trial.queue(priority=(len(settings) - i) /
+                        (len(settings) + 1.))
             trials.append(trial)
 
             # Should now contain i + 1 runnable trials
             # Otherwise it means another process is currently registering
             # or some trials changed of status from RUNNING to INTERRUPTED
             runnable_trials = list(self.get_runnable_trials(force_new=False))
-            if len(runnable_trials) > (i + 1):
+            if len(runnable_trials) > (n_runnable + i + 1):
                 logger.info(
                     "Some trials changed of status and became runnable during the "
                     "registering of new ones. Stop registering new trials.")
@@ -0,0 +1,60 @@
+import logging
+import time
+
+
+logger = logging.getLogger()
+
+
+class FairShare(object):
+    # Orders the experiments served by a worker so that each one gets trial
+    # wall time in proportion to its weight. Usage comes from the database,
+    # so all the workers agree on it, and is completed locally between
+    # refreshes.
+
+    def __init__(self, experiments, weights=None, refresh_interval=300):
+        self.experiments = list(experiments)
+        if weights is None:
+            weights = [1.] * len(self.experiments)
+        if len(weights) != len(self.experiments):
+            raise ValueError("Expected one weight per experiment, got %d "
+                             "for %d experiments" %
+                             (len(weights), len(self.experiments)))
+        if any(weight <= 0 for weight in weights):
+            raise ValueError("Weights must be positive: %s" % str(weights))
+
+        self.weights = [float(weight) for weight in weights]
+        self.refresh_interval = refresh_interval
+        self.usage = [0.] * len(self.experiments)
+        self.charged = [0.] * len(self.experiments)
+        self.refresh_time = None
+
+    def refresh(self):
+        # A single experiment has nothing to share
+        if len(self.experiments) < 2:
+            return
+
+        if (self.refresh_time is not None and
+                time.time() - self.refresh_time < self.refresh_interval):
+            return
+
+        for i, experiment in enumerate(self.experiments):
+            self.usage[i] = experiment.database.get_usage(experiment.name)
+            self.charged[i] = 0.
+        self.refresh_time = time.time()
+
+        logger.info("Trial seconds per experiment: %s" % ", ".join(
+            "%s=%d" % (experiment.name, usage)
+            for experiment, usage in zip(self.experiments, self.usage)))
+
+    def get_share(self, i):
+        return (self.usage[i] + self.charged[i]) / self.weights[i]
+
+    def iter_by_priority(self):
+        # Most underserved experiment first
+        self.refresh()
+        order = sorted(range(len(self.experiments)),
+                       key=lambda i: (self.get_share(i), i))
+        return (self.experiments[i] for i in order)
+
+    def charge(self, experiment, seconds):
+        self.charged[self.experiments.index(experiment)] += seconds
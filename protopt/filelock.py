@@ -0,0 +1,65 @@
+import fcntl
+import time
+
+
+class LockTimeout(RuntimeError):
+    pass
+
+
+class FileLock(object):
+    # flock() based lock for processes of the same node. Locks are held by
+    # the open file, so threads of a process exclude each other too. Must not
+    # be used on shared filesystems, see bin/opt-run for those.
+
+    def __init__(self, path, shared=False, timeout=None, poll_interval=1):
+        self.path = path
+        self.shared = shared
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.file = None
+
+    @property
+    def locked(self):
+        return self.file is not None
+
+    def acquire(self, blocking=True):
+        mode = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+        lock_file = open(self.path, "a")
+
+        start_time = time.time()
+        while True:
+            try:
+                fcntl.flock(lock_file, mode | fcntl.LOCK_NB)
+                self.file = lock_file
+                return True
+            except (IOError, OSError):
+                pass
+
+            elapsed = time.time() - start_time
+            if not blocking or (self.timeout is not None and
+                                elapsed >= self.timeout):
+                lock_file.close()
+                break
+
+            time.sleep(self.poll_interval)
+
+        if blocking:
+            raise LockTimeout("Could not lock %s in %d seconds" %
+                              (self.path, self.timeout))
+
+        return False
+
+    def release(self):
+        if self.file is None:
+            return
+
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
+        self.file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
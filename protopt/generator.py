@@ -0,0 +1,35 @@
+import logging
+import time
+
+
+logger = logging.getLogger()
+
+
+def generator_loop(experiment, pool_size, sleep_interval=60,
+                   max_iterations=None):
+    # Keeps at least `pool_size` runnable trials in the queue so that workers
+    # never have to fit the optimizer themselves. Does not need a GPU.
+    iteration = 0
+    while max_iterations is None or iteration < max_iterations:
+        iteration += 1
+
+        # Trials lost by dead workers become runnable again
+        experiment.database.reap_expired_trials()
+
+        n_runnable = experiment.count_runnable_trials()
+        logger.info("%d runnable trials in queue (target is %d)" %
+                    (n_runnable, pool_size))
+
+        if n_runnable < pool_size:
+            try:
+                experiment.create_new_trials(n_runnable=n_runnable)
+            except KeyboardInterrupt:
+                logger.info("Interruption requested by user")
+                return
+            continue
+
+        try:
+            time.sleep(sleep_interval)
+        except KeyboardInterrupt:
+            logger.info("Interruption requested by user")
+            return
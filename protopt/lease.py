@@ -0,0 +1,94 @@
+import datetime
+import logging
+import os
+import socket
+import uuid
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+
+logger = logging.getLogger()
+
+
+class Lease(object):
+    # Database-backed lease with a TTL. Every successful acquisition increments
+    # a fencing token so that a holder whose lease expired (and was taken over
+    # by someone else) can detect it before writing anything.
+
+    def __init__(self, collection, name, ttl=600):
+        self.collection = collection
+        self.name = name
+        self.ttl = ttl
+        self.owner = "%s:%d:%s" % (socket.gethostname(), os.getpid(),
+                                   uuid.uuid4().hex[:8])
+        self.token = None
+
+    def _expiry(self):
+        return datetime.datetime.utcnow() + datetime.timedelta(seconds=self.ttl)
+
+    def acquire(self):
+        now = datetime.datetime.utcnow()
+        try:
+            row = self.collection.find_one_and_update(
+                {
+                    "_id": self.name,
+                    "$or": [
+                        {"expires": {"$lt": now}},
+                        {"owner": self.owner}
+                    ]
+                },
+                {
+                    "$set": {"owner": self.owner, "expires": self._expiry()},
+                    "$inc": {"token": 1}
+                },
+                upsert=True, return_document=ReturnDocument.AFTER)
+        except DuplicateKeyError:
+            # Lease exists and is held by another process
+            self.token = None
+            return False
+
+        self.token = row["token"]
+        logger.debug("Acquired lease %s with token %d" %
+                     (self.name, self.token))
+        return True
+
+    def _held_query(self):
+        return {
+            "_id": self.name,
+            "owner": self.owner,
+            "token": self.token,
+            "expires": {"$gt": datetime.datetime.utcnow()}}
+
+    def is_valid(self):
+        if self.token is None:
+            return False
+
+        return self.collection.find_one(self._held_query()) is not None
+
+    def renew(self):
+        if self.token is None:
+            return False
+
+        result = self.collection.update_one(
+            self._held_query(),
+            {"$set": {"expires": self._expiry()}})
+
+        if result.modified_count != 1:
+            logger.info("Lease %s with token %d was lost" %
+                        (self.name, self.token))
+            self.token = None
+            return False
+
+        return True
+
+    def release(self):
+        if self.token is None:
+            return
+
+        self.collection.update_one(
+            {"_id": self.name, "owner": self.owner, "token": self.token},
+            {"$set": {"expires": datetime.datetime.utcnow()}})
+        logger.debug("Released lease %s with token %d" %
+                     (self.name, self.token))
+        self.token = None
@@ -0,0 +1,194 @@
+import logging
+
+import numpy
+
+import protopt.status
+from protopt.dedup import NeighbourIndex
+from protopt.duration import RuntimeModel, get_runtime
+
+
+logger = logging.getLogger()
+
+
+class TrialMatrix(object):
+    # Column store of the trials of an experiment, in the layout of a Space.
+    # Rows are kept across refreshes and only the trials which are new or
+    # still changing are converted again.
+
+    def __init__(self, space):
+        self.space = space
+        layout = space.get_layout()
+        self.index = NeighbourIndex(layout.dimensions, rtol=space.rtol)
+        self.runtime_model = RuntimeModel(layout.skopt_space)
+
+        n_dims = len(layout.names)
+        self.ids = numpy.zeros(0, dtype=object)
+        self.status = numpy.zeros(0, dtype=object)
+        self.objective = numpy.zeros(0)
+        # Seconds taken by completed trials, NaN for the others
+        self.runtime = numpy.zeros(0)
+        # 1 for completed trials, 0 for those which failed because of their
+        # configuration, NaN for the others
+        self.feasibility = numpy.zeros(0)
+        self.raw = numpy.zeros((0, n_dims), dtype=object)
+        self.transformed = numpy.zeros(
+            (0, layout.skopt_space.transformed_n_dims))
+        self.encoded = self.index.encode([])
+
+        self._rows = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    @staticmethod
+    def _get_objective(trial):
+        try:
+            return trial.result[1]
+        except Exception:
+            # We should be able to get the result if status is COMPLETED
+            assert trial.status not in protopt.status.COMPLETED
+            return numpy.nan
+
+    @staticmethod
+    def _get_runtime(trial):
+        runtime = None
+        if trial.status in protopt.status.COMPLETED:
+            runtime = get_runtime(trial.row)
+
+        return runtime if runtime is not None else numpy.nan
+
+    @staticmethod
+    def _get_feasibility(trial):
+        if trial.status in protopt.status.COMPLETED:
+            return 1.
+        elif trial.status == "INVALID":
+            return 0.
+        elif (trial.status == "FAILED" and
+                trial.row.get("info", {}).get("failure") ==
+                protopt.status.SCRIPT_FAILURE):
+            return 0.
+
+        # Not over yet, or failed because of the infrastructure
+        return numpy.nan
+
+    def update(self, trials):
+        seen = set()
+        new_trials = []
+        n_updated = 0
+        for trial in trials:
+            seen.add(trial.id)
+            i = self._rows.get(trial.id)
+            if i is None:
+                new_trials.append(trial)
+                continue
+
+            # Results of completed trials cannot change anymore
+            if (self.status[i] == trial.status and
+                    self.status[i] in protopt.status.COMPLETED):
+                continue
+
+            self.status[i] = trial.status
+            self.objective[i] = self._get_objective(trial)
+            self.runtime[i] = self._get_runtime(trial)
+            self.feasibility[i] = self._get_feasibility(trial)
+            n_updated += 1
+
+        removed = [trial_id for trial_id in self._rows if trial_id not in seen]
+        if removed:
+            self._remove(removed)
+
+        if new_trials:
+            self._append(new_trials)
+
+        logger.info("Trial matrix: %d new, %d updated and %d removed rows" %
+                    (len(new_trials), n_updated, len(removed)))
+
+        return self
+
+    def _remove(self, trial_ids):
+        keep = numpy.ones(len(self), dtype=bool)
+        for trial_id in trial_ids:
+            keep[self._rows[trial_id]] = False
+
+        for name in ["ids", "status", "objective", "runtime", "feasibility",
+                     "raw", "transformed", "encoded"]:
+            setattr(self, name, getattr(self, name)[keep])
+
+        self._rows = dict((trial_id, i) for i, trial_id in enumerate(self.ids))
+
+    def _append(self, trials):
+        layout = self.space.get_layout()
+
+        rows = [self.space.dict_to_list(trial.setting) for trial in trials]
+        raw = numpy.empty((len(rows), len(layout.names)), dtype=object)
+        for i, row in enumerate(rows):
+            for j, value in enumerate(row):
+                raw[i, j] = value
+
+        offset = len(self)
+        self.ids = numpy.concatenate(
+            [self.ids, numpy.array([trial.id for trial in trials],
+                                   dtype=object)])
+        self.status = numpy.concatenate(
+            [self.status, numpy.array([trial.status for trial in trials],
+                                      dtype=object)])
+        self.objective = numpy.concatenate(
+            [self.objective,
+             numpy.array([self._get_objective(trial) for trial in trials])])
+        self.runtime = numpy.concatenate(
+            [self.runtime,
+             numpy.array([self._get_runtime(trial) for trial in trials])])
+        self.feasibility = numpy.concatenate(
+            [self.feasibility,
+             numpy.array([self._get_feasibility(trial) for trial in trials])])
+        self.raw = numpy.concatenate([self.raw, raw])
+        self.transformed = numpy.concatenate(
+            [self.transformed, layout.skopt_space.transform(rows)])
+        self.encoded = numpy.concatenate(
+            [self.encoded, self.index.encode(rows)])
+
+        for i, trial in enumerate(trials):
+            self._rows[trial.id] = offset + i
+
+    @property
+    def infeasible(self):
+        return numpy.array([status in protopt.status.INFEASIBLE
+                            for status in self.status], dtype=bool)
+
+    @property
+    def feasible(self):
+        return ~self.infeasible
+
+    def get_points(self, mask=None):
+        raw = self.raw if mask is None else self.raw[mask]
+        return [list(row) for row in raw]
+
+    def get_x(self):
+        return self.get_points(self.feasible)
+
+    def get_y(self, strategy="cl_min"):
+        objective = self.objective[self.feasible]
+        known = objective[~numpy.isnan(objective)]
+
+        # Constant liar for trials which are not completed yet
+        if not len(known):
+            lie = 0.0
+        elif strategy == "cl_min":
+            lie = numpy.min(known)
+        elif strategy == "cl_mean":
+            lie = numpy.mean(known)
+        else:
+            lie = numpy.max(known)
+
+        return [float(value) if not numpy.isnan(value) else float(lie)
+                for value in objective]
+
+    def get_known_objectives(self):
+        objective = self.objective[self.feasible]
+        return objective[~numpy.isnan(objective)]
+
+    def get_runtime_model(self):
+        return self.runtime_model.fit(self.transformed, self.runtime)
+
+    def get_neighbour_index(self):
+        return self.index.fit_encoded(self.encoded)
@@ -1,23 +1,41 @@
+import hashlib
 import logging
-from random import shuffle
+import random
 
 import numpy
 
 from skopt import Optimizer as SkoptOptimizer
 from skopt import Space as SkoptSpace
+from skopt.acquisition import gaussian_ei
 from skopt.learning import GaussianProcessRegressor
 
+from sklearn.ensemble import ExtraTreesClassifier
+
 
 logger = logging.getLogger()
 
+# How many more candidates are sampled to be ranked by expected improvement
+# per second
+COST_OVERSAMPLING = 3
+
+# Rounds of constant liar sampling after which the batch is completed with the
+# candidates the feasibility model rejected
+MAX_ASK_ROUNDS = 10
+
 
 class ValidatedSkoptOptimizer(SkoptOptimizer):
-    def __init__(self, dimensions, validate_sample, **kwargs):
+    def __init__(self, dimensions, validate_sample, canonicalize=None,
+                 feasibility=None, **kwargs):
         super(ValidatedSkoptOptimizer, self).__init__(dimensions, **kwargs)
 
         self.validate_sample = validate_sample
+        self.canonicalize = canonicalize
+        # FeasibilityModel filtering batches of samples, None to keep them all
+        self.feasibility = feasibility
         self.space = ValidatedSkoptSpace(dimensions,
-                                         validate_sample)
+                                         validate_sample,
+                                         canonicalize,
+                                         feasibility)
 
     def ask(self, n_points=None, strategy="cl_min"):
         """Query point or multiple points at which objective should be evaluated.
@@ -61,33 +79,87 @@ class ValidatedSkoptOptimizer(SkoptOptimizer):
         if (n_points, strategy) in self.cache_:
             return self.cache_[(n_points, strategy)]
 
-        # Copy of the optimizer is made in order to manage the
-        # deletion of points with "lie" objective (the copy of
-        # optimizer is simply discarded)
-        opt = self.copy(
-            random_state=self.rng.randint(0, numpy.iinfo(numpy.int32).max))
+        # Points told to every copy of the optimizer. A fresh copy is made
+        # for each round so that the points rejected by the feasibility model
+        # get a pessimistic lie instead of the constant one, and the
+        # acquisition moves away from them.
+        told = []
+        # (probability of being feasible, point), fallback of the last round
+        rejected = []
+        pessimistic_lie = numpy.max(self.yi) if self.yi else 0.0
 
         trashed = 0
         X = []
-        while len(X) < n_points:
-            x = opt.ask()
-            X.append(x)
-
-            if not self.validate_sample(x):
-                y_lie = 0.0  # Invalid sample
-                # Tell the main optimizer too
-                # Nah, we retrain from scratch each time anyway
-                # self.tell(x, y_lie)
-                X.pop(-1)
-                trashed += 1
-            elif strategy == "cl_min":
-                y_lie = numpy.min(opt.yi) if opt.yi else 0.0  # CL-min lie
-            elif strategy == "cl_mean":
-                y_lie = numpy.mean(opt.yi) if opt.yi else 0.0  # CL-mean lie
+        for _ in range(MAX_ASK_ROUNDS):
+            # Copy of the optimizer is made in order to manage the
+            # deletion of points with "lie" objective (the copy of
+            # optimizer is simply discarded)
+            opt = self.copy(
+                random_state=self.rng.randint(0, numpy.iinfo(numpy.int32).max))
+            if told:
+                opt.tell([x for x, _ in told], [y for _, y in told])
+
+            # Points are asked one at a time for the constant liar, then the
+            # batch is checked by the feasibility model in a single call.
+            batch = []
+            lies = []
+            while len(X) + len(batch) < n_points:
+                x = opt.ask()
+                if self.canonicalize is not None:
+                    # Inactive conditional dimensions are fixed
+                    x = self.canonicalize(x)
+
+                if not self.validate_sample(x):
+                    y_lie = 0.0  # Invalid sample
+                    # Tell the main optimizer too
+                    # Nah, we retrain from scratch each time anyway
+                    # self.tell(x, y_lie)
+                    trashed += 1
+                    told.append((x, y_lie))
+                else:
+                    if not opt.yi:
+                        y_lie = 0.0
+                    elif strategy == "cl_min":
+                        y_lie = numpy.min(opt.yi)  # CL-min lie
+                    elif strategy == "cl_mean":
+                        y_lie = numpy.mean(opt.yi)  # CL-mean lie
+                    else:
+                        y_lie = numpy.max(opt.yi)  # CL-max lie
+                    batch.append(x)
+                    lies.append(y_lie)
+
+                opt.tell(x, y_lie)  # lie to the optimizer
+
+            if self.feasibility is not None and batch:
+                probabilities = self.feasibility.predict_proba(batch)
             else:
-                y_lie = numpy.max(opt.yi) if opt.yi else 0.0  # CL-max lie
-
-            opt.tell(x, y_lie)  # lie to the optimizer
+                probabilities = numpy.ones(len(batch))
+
+            for x, y_lie, probability in zip(batch, lies, probabilities):
+                if (self.feasibility is None or
+                        probability >= self.feasibility.threshold):
+                    X.append(x)
+                    told.append((x, y_lie))
+                else:
+                    rejected.append((probability, x))
+                    told.append((x, pessimistic_lie))
+                    trashed += 1
+
+            if len(X) >= n_points:
+                break
+        else:
+            # The feasibility model rejects the whole region the acquisition
+            # favors, settle for the points most likely to be feasible
+            logger.warning("Could not sample %d feasible points in %d rounds, "
+                           "completing with the best rejected ones" %
+                           (n_points, MAX_ASK_ROUNDS))
+            rejected.sort(key=lambda item: -item[0])
+            X += [x for _, x in rejected[:n_points - len(X)]]
+            if len(X) < n_points:
+                unfiltered = ValidatedSkoptSpace(
+                    self.space.dimensions, self.validate_sample,
+                    self.canonicalize)
+                X += unfiltered._rvs(n_points - len(X))[0]
 
         logger.info("Optimizer.ask() trashed %d invalid samples" % trashed)
 
@@ -106,6 +178,8 @@ class ValidatedSkoptOptimizer(SkoptOptimizer):
         optimizer = ValidatedSkoptOptimizer(
             dimensions=self.space.dimensions,
             validate_sample=self.validate_sample,
+            canonicalize=self.canonicalize,
+            feasibility=self.feasibility,
             base_estimator=self.base_estimator_,
             n_initial_points=self.n_initial_points_,
             acq_func=self.acq_func,
@@ -125,10 +199,13 @@ class ValidatedSkoptOptimizer(SkoptOptimizer):
 
 
 class ValidatedSkoptSpace(SkoptSpace):
-    def __init__(self, dimensions, validate_sample=None):
+    def __init__(self, dimensions, validate_sample=None, canonicalize=None,
+                 feasibility=None):
         super(ValidatedSkoptSpace, self).__init__(dimensions)
 
         self.validate_sample = validate_sample
+        self.canonicalize = canonicalize
+        self.feasibility = feasibility
 
     def rvs(self, n_samples=1, random_state=None):
         rows, trashed = self._rvs(n_samples=1, random_state=None)
@@ -149,7 +226,12 @@ class ValidatedSkoptSpace(SkoptSpace):
         rows = super(ValidatedSkoptSpace, self).rvs(n_samples * 10,
                                                     random_state)
 
+        if self.canonicalize is not None:
+            rows = [self.canonicalize(row) for row in rows]
+
         rows = list(filter(self.validate_sample, rows))
+        if self.feasibility is not None:
+            rows = self.feasibility.filter(rows)
         trashed += n_samples * 10 - len(rows)
 
         if len(rows) < n_samples:
@@ -163,22 +245,172 @@ class ValidatedSkoptSpace(SkoptSpace):
         return rows[:n_samples], trashed
 
 
+class FeasibilityModel(object):
+    # Learns which regions of the space produce INVALID trials, or trials
+    # whose script failed, so that the optimizer stops proposing candidates
+    # there. Only trials which are over are labeled, see TrialMatrix.
+
+    def __init__(self, dimensions, threshold=0.5, min_infeasible=5):
+        self.space = SkoptSpace(dimensions)
+        self.threshold = threshold
+        self.min_infeasible = min_infeasible
+        self.classifier = None
+
+    def fit(self, matrix):
+        labeled = ~numpy.isnan(matrix.feasibility)
+        labels = matrix.feasibility[labeled].astype(int)
+        n_infeasible = int((labels == 0).sum())
+        if n_infeasible < self.min_infeasible or not labels.any():
+            logger.info("Not enough infeasible trials (%d) to train the "
+                        "feasibility model" % n_infeasible)
+            self.classifier = None
+            return self
+
+        logger.info("Training feasibility model on %d feasible and %d "
+                    "infeasible points" % (labels.sum(), n_infeasible))
+        self.classifier = ExtraTreesClassifier(
+            n_estimators=100, min_samples_leaf=2, class_weight="balanced")
+        self.classifier.fit(matrix.transformed[labeled], labels)
+
+        return self
+
+    @property
+    def fitted(self):
+        return self.classifier is not None
+
+    def predict_proba(self, rows):
+        if self.classifier is None:
+            return numpy.ones(len(rows))
+
+        probabilities = self.classifier.predict_proba(self.space.transform(rows))
+        feasible_index = list(self.classifier.classes_).index(1)
+        return probabilities[:, feasible_index]
+
+    def filter(self, rows):
+        # Scores the whole batch at once, the classifier is slow per call
+        rows = list(rows)
+        if self.classifier is None or not rows:
+            return rows
+
+        feasible = self.predict_proba(rows) >= self.threshold
+        return [row for row, is_feasible in zip(rows, feasible)
+                if is_feasible]
+
+
+# Rounds of the Feistel network permuting the grid
+FEISTEL_ROUNDS = 4
+
+MASK_64 = 2 ** 64 - 1
+
+
+def _mix(value, key):
+    # splitmix64 finalizer, every bit of the input affects every bit of the
+    # output
+    value = (value ^ key) & MASK_64
+    value = ((value ^ (value >> 30)) * 0xbf58476d1ce4e5b9) & MASK_64
+    value = ((value ^ (value >> 27)) * 0x94d049bb133111eb) & MASK_64
+    return value ^ (value >> 31)
+
+
+def get_default_seed(name):
+    # Stable across processes, unlike hash()
+    return int(hashlib.sha1(name.encode("utf-8")).hexdigest()[:16], 16)
+
+
 class GridSearch(object):
-    def __init__(self, pool_size, grid):
+    # The grid is defined by the values of each axis, in the order of
+    # Space.get_spaces(). Points are never materialized, they are enumerated
+    # lazily following a seeded pseudo-random permutation of their indices in
+    # the cartesian product. The seed defaults to a hash of the name of the
+    # experiment so that all the workers follow the same order. With
+    # conditional dimensions, canonicalize is Space.canonicalize and points
+    # differing only on inactive dimensions are the same candidate.
+
+    def __init__(self, pool_size, axes, seed=None, name="", canonicalize=None):
         self.pool_size = pool_size
-        self.grid = [tuple(e) for e in grid]
-        shuffle(self.grid)
+        self.canonicalize = canonicalize
+        self.axes = [list(values) for values in axes]
+        self.axes_indices = [dict((value, i) for i, value in enumerate(values))
+                             for values in self.axes]
+        self.size = 1
+        for values in self.axes:
+            self.size *= len(values)
+
+        if seed is None:
+            seed = get_default_seed(name)
+
+        # Balanced Feistel network over the smallest even number of bits
+        # covering the grid, indices outside of it are walked back in
+        self.half_bits = max((self.size - 1).bit_length() + 1, 2) // 2
+        self.half_mask = 2 ** self.half_bits - 1
+        rng = random.Random(seed)
+        self.keys = [rng.getrandbits(64) for _ in range(FEISTEL_ROUNDS)]
+
         self.strategy = None
 
-    def get_new_candidates(self, x, y):
-        already_queued = set(tuple(e) for e in x)
-        candidates = []
-        for candidate in self.grid:
-            if candidate not in already_queued:
-                candidates.append(candidate)
+    def __len__(self):
+        return self.size
 
-            if len(candidates) >= self.pool_size:
-                break
+    def __contains__(self, point):
+        return self._point_to_index(point) is not None
+
+    def _feistel(self, value):
+        left, right = value >> self.half_bits, value & self.half_mask
+        for key in self.keys:
+            left, right = right, left ^ (_mix(right, key) & self.half_mask)
+
+        return (left << self.half_bits) | right
+
+    def _position_to_index(self, position):
+        # Cycle walking, the domain is at most 4 times larger than the grid
+        index = self._feistel(position)
+        while index >= self.size:
+            index = self._feistel(index)
+
+        return index
+
+    def _index_to_point(self, index):
+        point = []
+        for values in reversed(self.axes):
+            index, i = divmod(index, len(values))
+            point.append(values[i])
+
+        return tuple(reversed(point))
+
+    def _point_to_index(self, point):
+        if len(point) != len(self.axes):
+            return None
+
+        index = 0
+        for value, values, indices in zip(point, self.axes, self.axes_indices):
+            i = indices.get(value)
+            if i is None:
+                return None
+            index = index * len(values) + i
+
+        return index
+
+    def _get_canonical(self, point):
+        if self.canonicalize is None:
+            return tuple(point)
+
+        return tuple(self.canonicalize(list(point)))
+
+    def get_new_candidates(self, matrix, prior=None):
+        # Rows of the matrix are canonical already
+        already_queued = set(tuple(row) for row in matrix.raw)
+
+        # Only the trials in the matrix count, points whose trial was
+        # deleted are proposed again.
+        candidates = []
+        position = 0
+        while position < self.size and len(candidates) < self.pool_size:
+            point = self._get_canonical(
+                self._index_to_point(self._position_to_index(position)))
+            if point not in already_queued:
+                candidates.append(point)
+                already_queued.add(point)
+            position += 1
 
         return candidates
 
@@ -193,27 +425,37 @@ class GridSearchThenOptimizer(object):
     def pool_size(self):
         return self.grid_search.pool_size
 
-    def get_new_candidates(self, x, y):
-        candidates = self.grid_search.get_new_candidates(x, y)
+    def get_new_candidates(self, matrix, prior=None):
+        candidates = self.grid_search.get_new_candidates(matrix)
 
         if len(candidates) < self.pool_size:
-            candidates = self.optimizer.get_new_candidates(x, y)
+            candidates = self.optimizer.get_new_candidates(matrix, prior)
 
         return candidates[:self.pool_size]
 
 
 class Optimizer(object):
-    def __init__(self, pool_size, space, strategy="cl_min"):
+    def __init__(self, pool_size, space, strategy="cl_min",
+                 feasibility_threshold=0.5, cost_aware=False):
         self.pool_size = pool_size
         self.space = space
         self.strategy = strategy
+        self.feasibility_threshold = feasibility_threshold
+        self.feasibility = None
+        # Rank candidates by expected improvement per second of runtime
+        self.cost_aware = cost_aware
 
     def _build_optimizer(self, **kwargs):
         print("Building optimizer")
+        feasibility = None
+        if self.feasibility is not None and self.feasibility.fitted:
+            feasibility = self.feasibility
         optimizer = ValidatedSkoptOptimizer(
             base_estimator=GaussianProcessRegressor(**kwargs),
             dimensions=list(self.space.get_spaces().values()),
-            validate_sample=self.space.get_validate_sample_fct()
+            validate_sample=self.space.get_validate_sample_fct(),
+            canonicalize=self.space.canonicalize,
+            feasibility=feasibility
         )
 
         return optimizer
@@ -230,16 +472,21 @@ class Optimizer(object):
         optimizer = self._build_optimizer()
         return optimizer.space.rvs(n_samples=self.pool_size)
 
-    def _get_bayesian_opt_candidate(self, x, y, maximum_tries):
+    def _get_bayesian_opt_candidate(self, x, y, maximum_tries,
+                                    runtime_model=None):
+        n_points = self.pool_size
+        if runtime_model is not None:
+            n_points *= COST_OVERSAMPLING
+
         alpha = 0.
         number_of_tries = 0
         while True:
             try:
                 logger.info("Training optimizer on %d points" % len(x))
                 optimizer = self._get_trained_optimizer(x, y, alpha=alpha)
-                logging.info("Sampling %d new points" % self.pool_size)
+                logging.info("Sampling %d new points" % n_points)
                 new_candidates = optimizer.ask(
-                    n_points=self.pool_size,
+                    n_points=n_points,
                     strategy=self.strategy)
                 break
             except numpy.linalg.linalg.LinAlgError as e:
@@ -251,21 +498,61 @@ class Optimizer(object):
                 if number_of_tries >= maximum_tries:
                     raise
 
+        if runtime_model is not None:
+            new_candidates = self._rank_by_cost(optimizer, new_candidates,
+                                                runtime_model)
+
         return new_candidates
 
-    def get_new_candidates(self, x, y, maximum_tries=10):
+    def _rank_by_cost(self, optimizer, candidates, runtime_model):
+        # Keeps the pool_size candidates with the best expected improvement
+        # per second
+        if not optimizer.models:
+            # Still sampling initial points
+            return candidates[:self.pool_size]
+
+        improvement = gaussian_ei(optimizer.space.transform(candidates),
+                                  optimizer.models[-1],
+                                  y_opt=numpy.min(optimizer.yi))
+        score = improvement / runtime_model.predict(candidates)
+        ranking = numpy.argsort(-score)[:self.pool_size]
+        logger.info("Kept %d candidates with the best expected improvement "
+                    "per second" % len(ranking))
+
+        return [candidates[i] for i in ranking]
+
+    def get_new_candidates(self, matrix, prior=None, maximum_tries=10):
+        x = matrix.get_x()
+        y = matrix.get_y(self.strategy)
+
+        # Observations from related experiments are only used to train the
+        # surrogate. They are not considered duplicates so that good source
+        # configurations can be evaluated again in this experiment.
+        x_prior, y_prior = prior if prior is not None else ([], [])
+
+        if self.feasibility is None:
+            self.feasibility = FeasibilityModel(
+                list(self.space.get_spaces().values()),
+                threshold=self.feasibility_threshold)
+        self.feasibility.fit(matrix)
+
+        runtime_model = None
+        if self.cost_aware:
+            runtime_model = matrix.get_runtime_model()
+            if not runtime_model.fitted:
+                runtime_model = None
+
         if numpy.random.uniform() < 0.05:
             logger.info("Sampling random candidates")
             new_candidates = self._get_random_candidate()
         else:
             logger.info("Sampling candidates from Bayesian optimizer")
             new_candidates = self._get_bayesian_opt_candidate(
-                x, y, maximum_tries)
+                x + x_prior, y + y_prior, maximum_tries, runtime_model)
 
-        # Remove duplicates
-        past_candidates = set(tuple(c) for c in x)
-        unique_candidates = list(set(tuple(n_c) for n_c in new_candidates
-                                     if tuple(n_c) not in past_candidates))
+        # Remove duplicates, up to the space tolerance, of past and pending
+        # trials and among new candidates
+        unique_candidates = matrix.get_neighbour_index().filter(new_candidates)
         logger.info("Optimizer sampled %d unique candidates. "
                     "(There was %d duplicates)" %
                     (len(unique_candidates),
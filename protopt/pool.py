@@ -0,0 +1,169 @@
+import copy
+import logging
+import multiprocessing
+import os
+import subprocess
+import threading
+import time
+
+from protopt.wrapper import PREEMPTION_GRACE, preemption
+
+
+logger = logging.getLogger()
+
+
+def detect_gpus():
+    # Respect the allocation of the scheduler if there is one
+    visible_devices = os.environ.get("CUDA_VISIBLE_DEVICES")
+    if visible_devices is not None:
+        return [gpu.strip() for gpu in visible_devices.split(",")
+                if gpu.strip()]
+
+    try:
+        output = subprocess.check_output(["nvidia-smi", "-L"],
+                                         universal_newlines=True)
+    except (OSError, subprocess.CalledProcessError):
+        return []
+
+    gpus = [line for line in output.splitlines() if line.startswith("GPU")]
+    return [str(i) for i in range(len(gpus))]
+
+
+def detect_slots(n_workers=0, trials_per_gpu=1, cores_per_trial=1):
+    # Returns one gpu id per worker, None meaning CPU only. n_workers=0 means
+    # as many as the node can hold.
+    gpus = detect_gpus()
+    max_cpu_workers = max(multiprocessing.cpu_count() // cores_per_trial, 1)
+
+    if gpus:
+        slots = [gpu for gpu in gpus for _ in range(trials_per_gpu)]
+        slots = slots[:max_cpu_workers]
+    else:
+        logger.info("No GPU detected, running on CPU only")
+        slots = [None] * max_cpu_workers
+
+    if n_workers > 0:
+        # Spread workers evenly over GPUs if asked for more than available
+        slots = [slots[i % len(slots)] for i in range(n_workers)]
+
+    logger.info("Worker slots: %s" % str(slots))
+    return slots
+
+
+class Worker(threading.Thread):
+    def __init__(self, loop, experiment, slot, **loop_kwargs):
+        super(Worker, self).__init__(name="worker-%s" % str(slot))
+        self.daemon = True
+        self.loop = loop
+        self.experiment = experiment
+        self.slot = slot
+        self.loop_kwargs = loop_kwargs
+        self.error = None
+
+    def get_running_trials(self):
+        # (database, trial id, claim) of the trial being run, if any
+        experiments = self.experiment
+        if not isinstance(experiments, list):
+            experiments = [experiments]
+
+        for experiment in experiments:
+            run_entry = experiment.database.mongo_observer.run_entry
+            if run_entry is not None and run_entry.get("status") == "RUNNING":
+                yield (experiment.database, run_entry["_id"],
+                       run_entry.get("claim"))
+
+    def run(self):
+        try:
+            self.loop(self.experiment, **self.loop_kwargs)
+        except BaseException as e:
+            logger.error("Worker on slot %s crashed: %s" %
+                         (str(self.slot), str(e)))
+            self.error = e
+
+
+class WorkerPool(object):
+    # Runs one worker thread per slot in the same process. Trials are
+    # executed in subprocesses by the wrapper, so threads are enough. The
+    # database connection, compiled space, optimizer and trial matrix are
+    # shared by all workers.
+
+    def __init__(self, loop, experiment, slots, max_restarts=3,
+                 check_interval=10, **loop_kwargs):
+        self.loop = loop
+        self.experiment = experiment
+        self.slots = slots
+        self.max_restarts = max_restarts
+        self.check_interval = check_interval
+        self.loop_kwargs = loop_kwargs
+        self.restarts = [0] * len(slots)
+        self.workers = [None] * len(slots)
+
+    def _build_experiment(self, slot):
+        # The loop may serve several experiments, see multi_loop()
+        if isinstance(self.experiment, list):
+            return [self._clone(experiment, slot)
+                    for experiment in self.experiment]
+
+        return self._clone(self.experiment, slot)
+
+    @staticmethod
+    def _clone(experiment, slot):
+        space = copy.copy(experiment.space)
+        space.opt = copy.copy(space.opt)
+        space.opt.gpu_id = slot
+
+        return experiment.clone(space=space)
+
+    def _start(self, i):
+        slot = self.slots[i]
+        logger.info("Starting worker %d on slot %s" % (i, str(slot)))
+        worker = Worker(self.loop, self._build_experiment(slot), slot,
+                        **self.loop_kwargs)
+        worker.start()
+        self.workers[i] = worker
+
+    def run(self):
+        for i in range(len(self.slots)):
+            self._start(i)
+
+        try:
+            while any(worker is not None for worker in self.workers):
+                time.sleep(self.check_interval)
+                for i, worker in enumerate(self.workers):
+                    if worker is None or worker.is_alive():
+                        continue
+
+                    if (worker.error is not None and
+                            self.restarts[i] < self.max_restarts):
+                        self.restarts[i] += 1
+                        logger.info("Restarting worker %d (%d/%d)" %
+                                    (i, self.restarts[i], self.max_restarts))
+                        self._start(i)
+                    else:
+                        logger.info("Worker %d finished" % i)
+                        self.workers[i] = None
+        except KeyboardInterrupt:
+            logger.info("Interruption requested by user")
+            self.stop()
+
+    def stop(self):
+        # Workers are daemon threads, they would die with the process and
+        # leave their trials RUNNING until their lease expires. They are
+        # asked to wind down like on preemption instead.
+        preemption.request("the user")
+
+        deadline = time.time() + PREEMPTION_GRACE + self.check_interval
+        for i, worker in enumerate(self.workers):
+            if worker is None:
+                continue
+
+            try:
+                worker.join(max(deadline - time.time(), 0))
+            except KeyboardInterrupt:
+                logger.info("Not waiting for the workers anymore")
+                deadline = 0
+
+            for database, trial_id, claim in worker.get_running_trials():
+                if database.interrupt_trial(trial_id, claim):
+                    logger.info("Worker %d did not stop in time, trial %s "
+                                "set to INTERRUPTED" % (i, str(trial_id)))
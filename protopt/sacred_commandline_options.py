@@ -1,14 +1,18 @@
+import copy
+import datetime
 import logging
 import os
 
-import numpy
-
 from sacred.commandline_options import CommandLineOption
 from sacred.observers import MongoObserver
 from sacred.utils import join_paths
 
 import smartdispatch.utils
 
+from protopt.checkpoints import CheckpointStore, is_local
+from protopt.database import (
+    PRIORITY_SORT, get_claimable_query, new_claim)
+from protopt.space import RTOL, get_tolerance_interval
 from protopt.utils import SacredSelectionError
 
 
@@ -17,6 +21,9 @@ logger = logging.getLogger(__name__)
 
 STOPPED_STATES = ["QUEUED", "INTERRUPTED", "TIMED_OUT"]
 
+# Seconds a claimed trial stays RUNNING without heartbeat before being reaped
+DEFAULT_LEASE_TTL = 300
+
 
 class SelectOption(CommandLineOption):
     """ Select job with given id or {first, random, last}"""
@@ -28,25 +35,24 @@ class SelectOption(CommandLineOption):
     @classmethod
     def get_id(cls, args, table):
         if args in ["first", "last", "random"]:
-            rows = table.find(
-                {"status":
-                    {"$in": STOPPED_STATES}})
-
-            if args == "first":
-                print(rows.count())
-                return rows[0]["_id"]
-            elif args == "last":
-                return rows[rows.count() - 1]["_id"]
-            else:  # args == "random":
-                if rows.count() > 1:
-                    random_index = numpy.random.randint(rows.count())
-                else:
-                    random_index = 0
-
-                selected_id = rows[random_index]["_id"]
-                logger.info("Selected id: %d (@index %d)" %
-                            (selected_id, random_index))
-                return selected_id
+            # Only trials whose checkpoint can be reached from this cluster
+            query = get_claimable_query()
+
+            if args == "random":
+                rows = list(table.aggregate([{"$match": query},
+                                             {"$sample": {"size": 1}}]))
+                row = rows[0] if rows else None
+            else:
+                sort = PRIORITY_SORT
+                if args == "last":
+                    sort = [(key, -direction) for key, direction in sort]
+                row = table.find_one(query, {"_id": 1}, sort=sort)
+
+            if row is None:
+                raise SacredSelectionError("No runnable trial to select")
+
+            logger.info("Selected id: %d" % row["_id"])
+            return row["_id"]
         else:
             return int(args)
 
@@ -66,9 +72,26 @@ class SelectOption(CommandLineOption):
             raise SacredSelectionError(
                 "Cannot run a job which has status "
                 "\"%s\"" % str(row["status"]))
+        claimed_from = copy.deepcopy(row)
+
+        # Resume the job where its checkpoint is, or from the copy migrated
+        # to GridFS
+        checkpoint = row.get("info", {}).get("checkpoint", {})
+        restore = False
+        if (row["status"] in ["INTERRUPTED", "TIMED_OUT"] and
+                "cluster" in checkpoint):
+            if not is_local(checkpoint):
+                if checkpoint.get("artifact") is None:
+                    raise SacredSelectionError(
+                        "Checkpoint of the job is on cluster %s (%s)" %
+                        (checkpoint["cluster"], checkpoint["path"]))
+                restore = True
+
+            run.config["resume"] = True
+            row["config"]["resume"] = True
 
         # Make sure the job is resumed on the same cluster it ran on
-        if "host" in row and row["status"] in ["INTERRUPTED", "TIMED_OUT"]:
+        elif "host" in row and row["status"] in ["INTERRUPTED", "TIMED_OUT"]:
             current_cluster_name = smartdispatch.utils.detect_cluster()
             ran_on_cluster = row["host"].get("cluster", None)
             if (ran_on_cluster is not None and
@@ -87,14 +110,18 @@ class SelectOption(CommandLineOption):
             run.config["resume"] = True
             row["config"]["resume"] = True
 
-        # Set it to running quickly to avoid race conditions
+        # Set it to running quickly to avoid race conditions. The claim token
+        # fences the writes of a previous owner of the trial.
+        lease_expiry = get_lease_expiry(mongodb_observer)
+        claim = new_claim()
         result = table.update_one(
             {
                 "_id": int(row['_id']),
                 "status": {"$eq": row["status"]}
             },
             {
-                "$set": {"status": "RUNNING"}
+                "$set": {"status": "RUNNING", "lease_expiry": lease_expiry,
+                         "claim": claim}
             })
 
         if not result.acknowledged:
@@ -110,9 +137,26 @@ class SelectOption(CommandLineOption):
                 raise SacredSelectionError("Trial dissapeared from db... "
                                            "scary.")
 
+        if restore:
+            try:
+                row["info"]["checkpoint"] = CheckpointStore(
+                    mongodb_observer.fs).download(
+                        row["_id"], checkpoint, run.config["save_path"])
+            except Exception as e:
+                # Give the trial back to the other workers
+                table.update_one(
+                    {"_id": int(row['_id']), "claim": claim},
+                    {"$set": {"status": row["status"]},
+                     "$unset": {"lease_expiry": ""}})
+                raise SacredSelectionError(
+                    "Could not download the checkpoint: %s" % str(e))
+
         row["status"] = "RUNNING"
+        row["lease_expiry"] = lease_expiry
+        row["claim"] = claim
         mongodb_observer.overwrite = row
         mongodb_observer.run_entry = None
+        mongodb_observer.claimed_from = claimed_from
 
         # Force sources to be similar otherwise sacred will always complain.
         # TODO: Why isn't sacred able to compare correctly similar sources?
@@ -133,8 +177,6 @@ class EnforceNewOption(CommandLineOption):
 
     @classmethod
     def apply(cls, args, run):
-        RTOL = 0.01
-
         mongodb_observers = [o for o in run.observers if isinstance(o, MongoObserver)]
         assert len(mongodb_observers) == 1
 
@@ -150,14 +192,21 @@ class EnforceNewOption(CommandLineOption):
                 raise RuntimeError("Cannot run a job which has status "
                                    "\"%s\"" % str(row["status"]))
 
+            mongodb_observer.claimed_from = copy.deepcopy(row)
             run.config["resume"] = True
             row["config"]["resume"] = True
 
             # Set it to running quickly to avoid race conditions
+            lease_expiry = get_lease_expiry(mongodb_observer)
+            claim = new_claim()
             table.update({"_id": int(row['_id'])},
-                         {"$set": {"status": "RUNNING"}})
+                         {"$set": {"status": "RUNNING",
+                                   "lease_expiry": lease_expiry,
+                                   "claim": claim}})
 
             row["status"] = "RUNNING"
+            row["lease_expiry"] = lease_expiry
+            row["claim"] = claim
             mongodb_observer.overwrite = row
 
         else:
@@ -165,6 +214,7 @@ class EnforceNewOption(CommandLineOption):
                                  run.main_function.signature.name)
 
             run.run_logger.info("Reserving setting in DB")
+            mongodb_observer.claimed_from = None
             mongodb_observer.started_event(
                 ex_info=run.experiment_info,
                 command=command,
@@ -189,6 +239,14 @@ class EnforceNewOption(CommandLineOption):
         run.info = row["info"]
 
 
+def get_lease_expiry(mongodb_observer):
+    if hasattr(mongodb_observer, "get_lease_expiry"):
+        return mongodb_observer.get_lease_expiry()
+
+    return (datetime.datetime.utcnow() +
+            datetime.timedelta(seconds=DEFAULT_LEASE_TTL))
+
+
 def find_config(mongodb_observer, config, table, rtol):
     query = create_comparison_query(config, rtol)
     rows = table.find(query)
@@ -198,7 +256,7 @@ def find_config(mongodb_observer, config, table, rtol):
         return None
 
 
-def create_comparison_query(config, rtol=0.01):
+def create_comparison_query(config, rtol=RTOL):
     ignore = ["seed", "dataroot", "nthread", "resume", "save", "tensorboard",
               "verbose"]
     query = {}
@@ -207,9 +265,10 @@ def create_comparison_query(config, rtol=0.01):
             continue
 
         if isinstance(hp_value, float):
+            low, high = get_tolerance_interval(hp_value, rtol)
             hp_comparison = {
-                "$gte": hp_value * (1 - rtol),
-                "$lte": hp_value * (1 + rtol)
+                "$gte": low,
+                "$lte": high
             }
         else:
             # Use pure equality
@@ -5,12 +5,28 @@ import functools
 import numpy
 
 from skopt import Space as SkoptSpace
-from skopt.space import Real
+from skopt.space import Categorical, Real
 from skopt.utils import check_x_in_space
 
 
 COEFFICIENT_LIMIT = 1e-10
 
+# Relative tolerance under which two values of a real hyper-parameter are
+# considered the same.
+RTOL = 0.01
+
+# BSON type of null values, see Space.get_query()
+BSON_NULL = 10
+
+
+def get_tolerance_interval(value, rtol=RTOL):
+    # Values of a real hyper-parameter which are the same as value: those of
+    # the same sign whose ratio with it is at most 1 + rtol. Symmetric, and
+    # zero only matches itself. Shared by the database queries and the
+    # in-memory NeighbourIndex.
+    low, high = value / (1. + rtol), value * (1. + rtol)
+    return min(low, high), max(low, high)
+
 
 class Integer(Real):
     def __repr__(self):
@@ -20,6 +36,88 @@ class Integer(Real):
         return super(Integer, self).inverse_transform(Xt).astype(numpy.int)
 
 
+class SpaceLayout(object):
+    # Everything Space needs for conversions, compiled once per
+    # (model, profiles) pair. Must not be modified after construction.
+
+    def __init__(self, dimensions, profile_values, defaults, conditions=None):
+        self.names = tuple(dimensions.keys())
+        self.dimensions = tuple(dimensions.values())
+        self.indices = dict((name, i) for i, name in enumerate(self.names))
+        self.profile_values = tuple(sorted(profile_values.items()))
+        self.defaults = dict((name, defaults[name]) for name in self.names
+                             if name in defaults)
+        self.skopt_space = SkoptSpace(list(self.dimensions))
+
+        # Value given to a dimension when it is inactive, so that samplers
+        # and surrogates see a constant.
+        self.canonical = tuple(
+            self._get_canonical(name, dimension)
+            for name, dimension in zip(self.names, self.dimensions))
+
+        self.conditions = self._compile_conditions(
+            conditions or {}, dict(profile_values))
+
+        # Bounds of numerical dimensions, NaN for categorical ones
+        self.lows = numpy.array(
+            [numpy.nan if isinstance(dimension, Categorical) else dimension.low
+             for dimension in self.dimensions], dtype=float)
+        self.highs = numpy.array(
+            [numpy.nan if isinstance(dimension, Categorical) else dimension.high
+             for dimension in self.dimensions], dtype=float)
+
+    def _get_canonical(self, name, dimension):
+        if name in self.defaults and self.defaults[name] in dimension:
+            return self.defaults[name]
+        elif isinstance(dimension, Categorical):
+            return dimension.categories[0]
+
+        return dimension.low
+
+    def _compile_conditions(self, conditions, profile_values):
+        # Returns (child index, parent index, active values) sorted such that
+        # parents are always resolved before their children. A parent index of
+        # None means the parent is pinned by a profile.
+        def depth(name):
+            if name not in conditions:
+                return 0
+            return 1 + depth(conditions[name][0])
+
+        compiled = []
+        for child in sorted(conditions, key=depth):
+            if child not in self.indices:
+                continue
+
+            parent, values = conditions[child]
+            if parent in self.indices:
+                compiled.append((self.indices[child], self.indices[parent],
+                                 tuple(values)))
+            elif profile_values.get(parent) not in values:
+                # Pinned by a profile to a value which never activates it
+                compiled.append((self.indices[child], None, tuple(values)))
+
+        return tuple(compiled)
+
+    def get_inactive(self, row):
+        inactive = set()
+        for child, parent, values in self.conditions:
+            if (parent is None or parent in inactive or
+                    row[parent] not in values):
+                inactive.add(child)
+
+        return inactive
+
+    def canonicalize(self, row):
+        row = list(row)
+        for i in self.get_inactive(row):
+            row[i] = self.canonical[i]
+
+        return row
+
+    def get_default(self, hp_name):
+        return self.defaults[hp_name]
+
+
 class Space(object):
     NON_BASE_SPACE = []
     BASE_SPACE = []
@@ -29,52 +127,136 @@ class Space(object):
     PROFILES = {
         None: {}}
 
+    # Conditional dimensions: {child: (parent, [values of parent for which
+    # child is active])}. Inactive dimensions are not part of stored
+    # configurations and take a constant value in the optimizer.
+    CONDITIONS = {}
+
+    rtol = RTOL
+
     def __init__(self, model, defaults, opt):
         self.model = model
         self.opt = opt
         self.defaults = defaults
         self.opt.profiles = list(sorted(self.opt.profiles))
+        self._layouts = {}
 
     # TODO finish profiles
     def iter_profiles(self):
         return ((profile, self.PROFILES[profile])
                 for profile in [None] + self.opt.profiles)
 
+    def get_layout(self):
+        key = (self.model, tuple(self.opt.profiles))
+        layout = self._layouts.get(key)
+        if layout is None:
+            layout = self._layouts[key] = self._compile_layout()
+
+        return layout
+
+    def invalidate_layout(self):
+        # Must be called after modifying the dimensions of SPACES, layouts
+        # are compiled once. Objects already built from the old layout, such
+        # as a TrialMatrix, keep it.
+        self._layouts = {}
+
+    def _compile_layout(self):
+        profile_values = {}
+        for name, profile in self.iter_profiles():
+            profile_values.update(profile)
+
+        model_spaces = OrderedDict()
+        for hp_name, dimension in self.SPACES.items():
+            if ((hp_name in self.BASE_SPACE or
+                 hp_name in self.MODELS[self.model]) and
+                    hp_name not in profile_values):
+
+                model_spaces[hp_name] = dimension
+
+        defaults = copy.copy(self.defaults)
+        defaults.update(profile_values)
+
+        return SpaceLayout(model_spaces, profile_values, defaults,
+                           self.CONDITIONS)
+
     def validate(self, setting):
+        layout = self.get_layout()
 
         valid = True
-        for name, profile in self.iter_profiles():
-            for key, value in profile.items():
-                valid = valid and setting.get(key) == value
+        for key, value in layout.profile_values:
+            valid = valid and setting.get(key) == value
 
-        skopt_space = SkoptSpace(list(self.get_spaces().values()))
         try:
-            check_x_in_space(self.dict_to_list(setting), skopt_space)
+            check_x_in_space(self.dict_to_list(setting), layout.skopt_space)
         except ValueError as e:
             valid = False
 
         return valid
 
-    def get_spaces(self):
-        model_spaces = OrderedDict()
+    def get_query(self):
+        # Database equivalent of validate(). Dimensions which cannot be
+        # expressed as a query are left to the Python fallback (see
+        # requires_validation()).
+        layout = self.get_layout()
+        conditional = set(child for child, _, _ in layout.conditions)
+
+        query = {}
+        for key, value in layout.profile_values:
+            query["config.%s" % key] = {"$eq": value}
+
+        clauses = []
+        for i, (hp_name, dimension) in enumerate(zip(layout.names,
+                                                     layout.dimensions)):
+            if i in conditional:
+                continue
+
+            key = "config.%s" % hp_name
+            if isinstance(dimension, Categorical):
+                categories = list(dimension.categories)
+                alternatives = [{key: {"$in": [
+                    category for category in categories
+                    if category is not None]}}]
+                if None in categories:
+                    # A null in $in also matches missing values, the type
+                    # only matches explicit ones
+                    alternatives.append({key: {"$type": BSON_NULL}})
+            else:
+                alternatives = [
+                    {key: {"$gte": dimension.low, "$lte": dimension.high}}]
 
-        profiles_hps = sum(
-            (list(profile.keys()) for _, profile in self.iter_profiles()),
-            [])
+            if (hp_name in layout.defaults and
+                    layout.defaults[hp_name] in dimension):
+                # Missing values take the default which is valid
+                alternatives.insert(0, {key: {"$exists": False}})
 
-        for hp_name, dimension in self.SPACES.items():
-            if ((hp_name in self.BASE_SPACE or
-                 hp_name in self.MODELS[self.model]) and
-                    hp_name not in profiles_hps):
+            if len(alternatives) > 1:
+                clauses.append({"$or": alternatives})
+            else:
+                clauses.append(alternatives[0])
 
-                model_spaces[hp_name] = dimension
+        if clauses:
+            query["$and"] = clauses
+
+        return query
+
+    def requires_validation(self):
+        # Conditional dimensions are only checked in Python
+        return len(self.get_layout().conditions) > 0
+
+    def contains(self, row):
+        try:
+            check_x_in_space(row, self.get_layout().skopt_space)
+        except ValueError:
+            return False
 
-        return model_spaces
+        return True
+
+    def get_spaces(self):
+        layout = self.get_layout()
+        return OrderedDict(zip(layout.names, layout.dimensions))
 
     def force_profiles(self, setting):
-        for name, profile in self.iter_profiles():
-            for key, value in profile.items():
-                setting[key] = value
+        setting.update(self.get_layout().profile_values)
 
     def force_options(self, setting):
         # setting["verbose"] = self.opt.verbose_process
@@ -82,23 +264,25 @@ class Space(object):
         setting["gpu_id"] = self.opt.gpu_id
 
     def list_to_dict(self, space):
-        setting = dict(list(zip(list(self.get_spaces().keys()), space)))
+        layout = self.get_layout()
+        inactive = layout.get_inactive(space)
+        setting = dict((hp_name, value) for i, (hp_name, value)
+                       in enumerate(zip(layout.names, space))
+                       if i not in inactive)
         self.force_options(setting)
         self.force_profiles(setting)
 
         return setting
 
     def dict_to_list(self, setting):
-        setting = setting.copy()
+        layout = self.get_layout()
+        return layout.canonicalize(
+            [setting[hp_name] if hp_name in setting
+             else layout.get_default(hp_name)
+             for hp_name in layout.names])
 
-        default = self.get_default()
-        space = []
-        for hp_name in self.get_spaces().keys():
-            if hp_name in setting:
-                space.append(setting[hp_name])
-            else:
-                space.append(default[hp_name])
-        return space
+    def canonicalize(self, row):
+        return self.get_layout().canonicalize(row)
 
     def get_default(self):
         setting = copy.copy(self.defaults)
@@ -112,27 +296,38 @@ class Space(object):
 
     @staticmethod
     def _validate_sample(space, row):
+        if not space.contains(row):
+            return False
+
         setting = space.list_to_dict(row)
 
-        skopt_space = SkoptSpace(list(space.get_spaces().values()))
-        try:
-            check_x_in_space(row, skopt_space)
-        except ValueError:
-            return False
+        # Inactive children of conditional dimensions are not in the setting,
+        # rules reading one of them do not apply
+        layout = space.get_layout()
+        inactive = set(layout.names[i] for i in layout.get_inactive(row))
+
+        def active(*keys):
+            return not inactive.intersection(keys)
 
         has_activations_covariance_penalty = (
             setting.get("activations_covariance_penalty", 0.) >
             COEFFICIENT_LIMIT)
-        if (has_activations_covariance_penalty and
+        if (active("activations_covariance_penalty",
+                   "normalized_activations") and
+                has_activations_covariance_penalty and
                 (setting.get("normalized_activations", "NONE") != "NONE")):
             return False
 
-        if (setting.get("pre_projection_train_simultaneously") and
+        if (active("pre_projection_train_simultaneously",
+                   "pre_projection_train_alternatively") and
+                setting.get("pre_projection_train_simultaneously") and
                 setting.get("pre_projection_train_alternatively")):
             return False
 
         # Penalty type must be chosen
-        if (setting.get("pre_projection_train_alternatively") and
+        if (active("pre_projection_train_alternatively",
+                   "pre_projection_training_penalty") and
+                setting.get("pre_projection_train_alternatively") and
                 setting.get("pre_projection_training_penalty") is None):
             return False
 
@@ -142,14 +337,18 @@ class Space(object):
             centered_key = "centered_%s" % level
             # epsilon_key = "normalized_epsilon_%s" % level
 
-            if setting.get(rescaled_key) == "ALL":
-                if setting.get(normalized_key) != "ALL":
-                    return False
+            if active(rescaled_key, normalized_key):
+                if setting.get(rescaled_key) == "ALL":
+                    if setting.get(normalized_key) != "ALL":
+                        return False
 
-            if setting.get(rescaled_key) == "FEATURES":
-                if (setting.get(normalized_key)
-                        not in ["FEATURES", "ALL"]):
-                    return False
+                if setting.get(rescaled_key) == "FEATURES":
+                    if (setting.get(normalized_key)
+                            not in ["FEATURES", "ALL"]):
+                        return False
+
+            if not active(normalized_key, centered_key):
+                continue
 
             if setting.get(normalized_key) == "ALL":
                 if setting.get(centered_key) != "ALL":
@@ -166,7 +365,8 @@ class Space(object):
                         return False
 
             if setting.get(normalized_key) == "NONE":
-                if setting.get("force_library_batch_norm"):
+                if (active("force_library_batch_norm") and
+                        setting.get("force_library_batch_norm")):
                     if setting.get(centered_key) != "NONE":
                         return False
 
@@ -0,0 +1,311 @@
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+
+from protopt.filelock import FileLock, LockTimeout
+from protopt.utils import StagingProblem
+
+
+logger = logging.getLogger()
+
+# Node-local directory where datasets are staged. Defaults to the scratch of
+# the Slurm job, an empty value disables staging.
+STAGING_DIR = "PROTOPT_STAGING_DIR"
+# Maximum size of the staged datasets in GB
+STAGING_SIZE = "PROTOPT_STAGING_SIZE"
+DEFAULT_STAGING_SIZE = 50
+
+# Seconds to wait for another trial staging a dataset
+LOCK_TIMEOUT = 3600
+
+MANIFEST = "manifest.json"
+# Size of an entry being staged, counted before its manifest exists
+RESERVATION = "reserved.json"
+CHUNK_SIZE = 2 ** 20
+
+
+def get_staging_cache():
+    root = os.environ.get(STAGING_DIR)
+    if root is None and os.environ.get("SLURM_TMPDIR"):
+        root = os.path.join(os.environ["SLURM_TMPDIR"], "protopt_data")
+
+    if not root:
+        return None
+
+    max_size = float(os.environ.get(STAGING_SIZE, DEFAULT_STAGING_SIZE))
+    return StagingCache(root, int(max_size * 2 ** 30))
+
+
+@contextlib.contextmanager
+def stage_data_path(args):
+    # Points args["data_path"] to a node-local copy while the trial runs. The
+    # configuration saved in the database keeps the shared path so that the
+    # trial can be resumed on another node.
+    cache = get_staging_cache()
+    data_path = args.get("data_path")
+    if cache is None or not data_path or not os.path.exists(data_path):
+        yield
+        return
+
+    with cache.stage(data_path) as local_path:
+        if local_path is not None:
+            args["data_path"] = local_path
+        try:
+            yield
+        finally:
+            args["data_path"] = data_path
+
+
+def _iter_files(path):
+    # Yields (relative path, absolute path) of every file, sorted
+    if os.path.isfile(path):
+        yield "", path
+        return
+
+    for dir_path, dir_names, file_names in os.walk(path):
+        dir_names.sort()
+        for file_name in sorted(file_names):
+            file_path = os.path.join(dir_path, file_name)
+            yield os.path.relpath(file_path, path), file_path
+
+
+def get_signature(path):
+    # Cheap fingerprint telling whether the source changed since staging
+    return [[rel_path, os.path.getsize(file_path),
+             os.path.getmtime(file_path)]
+            for rel_path, file_path in _iter_files(path)]
+
+
+def hash_file(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def copy_file(source, destination):
+    # Copies and returns the hash of what was read
+    digest = hashlib.sha1()
+    with open(source, "rb") as source_file:
+        with open(destination, "wb") as destination_file:
+            for chunk in iter(lambda: source_file.read(CHUNK_SIZE), b""):
+                digest.update(chunk)
+                destination_file.write(chunk)
+
+    shutil.copystat(source, destination)
+
+    return digest.hexdigest()
+
+
+class StagingCache(object):
+    # One entry per source path: root/<key>/{data, manifest.json, lock} and
+    # root/<key>.lock. Trials hold a shared lock on the entry they use so
+    # that it is never evicted under their feet. The lock next to the entry
+    # serializes its staging, a dataset is only copied once per node while
+    # other datasets are staged concurrently. The lock of the root is only
+    # held to make room.
+
+    def __init__(self, root, max_size):
+        self.root = root
+        self.max_size = max_size
+
+    def get_entry(self, source):
+        key = hashlib.sha1(os.path.abspath(source).encode("utf-8")).hexdigest()
+        return os.path.join(self.root, key)
+
+    def get_local_path(self, entry, source):
+        # Keeps the name of the source, scripts may rely on its extension
+        return os.path.join(entry, "data",
+                            os.path.basename(source.rstrip(os.sep)))
+
+    @contextlib.contextmanager
+    def stage(self, source):
+        # Yields the path of the local copy of source, or None if it cannot
+        # be staged. Raises StagingProblem if another trial holds the entry
+        # for too long, the trial has nothing to do with it.
+        try:
+            entry_lock = self._acquire(source)
+        except LockTimeout as e:
+            raise StagingProblem(str(e))
+
+        if entry_lock is None:
+            yield None
+            return
+
+        try:
+            yield self.get_local_path(self.get_entry(source), source)
+        finally:
+            entry_lock.release()
+
+    def _acquire(self, source):
+        # Returns the shared lock of the staged entry, None if not staged
+        try:
+            os.makedirs(self.root)
+        except OSError:
+            if not os.path.isdir(self.root):
+                raise
+
+        entry = self.get_entry(source)
+        with FileLock(entry + ".lock", timeout=LOCK_TIMEOUT):
+            if not self._is_valid(entry, source):
+                self._stage(source, entry)
+
+                if not self._is_valid(entry, source):
+                    return None
+
+            entry_lock = FileLock(os.path.join(entry, "lock"), shared=True)
+            entry_lock.acquire()
+            # Entries are evicted in order of last use
+            os.utime(os.path.join(entry, MANIFEST), None)
+
+        return entry_lock
+
+    def _is_valid(self, entry, source):
+        # The signature is only computed again when the mtime of the source
+        # changed since the last check. Datasets are expected to be replaced
+        # rather than modified in place, which changes the mtime of their
+        # directory.
+        manifest_path = os.path.join(entry, MANIFEST)
+        try:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+        except (IOError, OSError, ValueError):
+            return False
+
+        source_mtime = os.path.getmtime(source)
+        if manifest.get("source_mtime") == source_mtime:
+            return True
+
+        if manifest["signature"] != get_signature(source):
+            return False
+
+        manifest["source_mtime"] = source_mtime
+        self._write(manifest_path, manifest)
+        return True
+
+    @staticmethod
+    def _write(path, content):
+        tmp_path = "%s.%d" % (path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump(content, f)
+        os.rename(tmp_path, path)
+
+    def _stage(self, source, entry):
+        source_mtime = os.path.getmtime(source)
+        signature = get_signature(source)
+        size = sum(size for _, size, _ in signature)
+
+        with FileLock(os.path.join(self.root, "lock"), timeout=LOCK_TIMEOUT):
+            if not self._make_room(size, exclude=entry):
+                logger.info("Not enough room to stage %s (%.1f GB)" %
+                            (source, size / 2. ** 30))
+                return
+
+            if os.path.isdir(entry):
+                # The source changed but the old copy may still be in use
+                entry_lock = FileLock(os.path.join(entry, "lock"))
+                if not entry_lock.acquire(blocking=False):
+                    logger.info("Outdated copy of %s still in use, not "
+                                "staged" % source)
+                    return
+                shutil.rmtree(entry)
+                entry_lock.release()
+            os.makedirs(entry)
+            self._write(os.path.join(entry, RESERVATION), size)
+
+        logger.info("Staging %s (%.1f GB)" % (source, size / 2. ** 30))
+        start_time = time.time()
+
+        try:
+            staged = self._copy(source, entry, signature, source_mtime, size)
+        except (IOError, OSError) as e:
+            # A full scratch for instance, the trial uses the shared copy
+            logger.warning("Could not stage %s, using it in place: %s" %
+                           (source, str(e)))
+            staged = False
+
+        if not staged:
+            shutil.rmtree(entry, ignore_errors=True)
+            return
+
+        logger.info("Staged %s in %.1f seconds" %
+                    (source, time.time() - start_time))
+
+    def _copy(self, source, entry, signature, source_mtime, size):
+        data_path = self.get_local_path(entry, source)
+        hashes = {}
+        for rel_path, file_path in _iter_files(source):
+            destination = os.path.join(data_path, rel_path).rstrip(os.sep)
+            if not os.path.isdir(os.path.dirname(destination)):
+                os.makedirs(os.path.dirname(destination))
+            hashes[rel_path] = copy_file(file_path, destination)
+
+        for rel_path, expected in hashes.items():
+            local_path = os.path.join(data_path, rel_path).rstrip(os.sep)
+            if hash_file(local_path) != expected:
+                logger.warning("Corrupted copy of %s, not staged" % rel_path)
+                return False
+
+        # Written last, an entry without manifest is incomplete
+        manifest = dict(source=os.path.abspath(source), signature=signature,
+                        source_mtime=source_mtime, hashes=hashes, size=size)
+        self._write(os.path.join(entry, MANIFEST), manifest)
+
+        return True
+
+    def _make_room(self, size, exclude):
+        if size > self.max_size:
+            return False
+
+        entries = []
+        used = 0
+        for name in os.listdir(self.root):
+            entry = os.path.join(self.root, name)
+            if entry == exclude or not os.path.isdir(entry):
+                continue
+
+            try:
+                with open(os.path.join(entry, MANIFEST)) as f:
+                    entry_size = json.load(f)["size"]
+                last_use = os.path.getmtime(os.path.join(entry, MANIFEST))
+            except (IOError, OSError, ValueError):
+                # Being staged, or left over by an interrupted staging
+                try:
+                    with open(os.path.join(entry, RESERVATION)) as f:
+                        entry_size = json.load(f)
+                except (IOError, OSError, ValueError):
+                    entry_size = 0
+                last_use = 0
+
+            entries.append((last_use, entry, entry_size))
+            used += entry_size
+
+        # Least recently used first
+        for last_use, entry, entry_size in sorted(entries):
+            if used + size <= self.max_size:
+                break
+
+            # Neither being staged nor in use by a running trial
+            staging_lock = FileLock(entry + ".lock")
+            if not staging_lock.acquire(blocking=False):
+                continue
+
+            entry_lock = FileLock(os.path.join(entry, "lock"))
+            try:
+                if not entry_lock.acquire(blocking=False):
+                    continue
+
+                logger.info("Evicting %s" % entry)
+                shutil.rmtree(entry)
+                used -= entry_size
+            finally:
+                entry_lock.release()
+                staging_lock.release()
+
+        return used + size <= self.max_size
@@ -3,3 +3,15 @@ QUEUED = ["QUEUED"]
 INTERRUPTED = ["INTERRUPTED", "TIMED_OUT"]
 RUNNABLE = ["QUEUED", "INTERRUPTED", "TIMED_OUT"]
 COMPLETED = ["COMPLETED"]
+
+# Trials which could not produce a result because of their configuration
+INFEASIBLE = ["INVALID", "FAILED"]
+
+# Recorded in info.failure of FAILED trials whose script failed. Other
+# failures come from the infrastructure and say nothing of the configuration.
+SCRIPT_FAILURE = "script"
+
+# Status of the interruptions of trials which never started, see
+# protopt.utils.StagingProblem. Never stored, the run is given back as it was
+# before being claimed.
+RELEASED = "RELEASED"
@@ -0,0 +1,141 @@
+import logging
+import os
+import subprocess
+import time
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+logger = logging.getLogger()
+
+# Seconds between two samples of the resources used by a trial, 0 disables
+# the sampling.
+TELEMETRY_INTERVAL = float(os.environ.get("PROTOPT_TELEMETRY_INTERVAL", 30))
+
+# Prefix of the metrics logged on the run
+PREFIX = "resources_"
+
+MB = 2. ** 20
+
+
+def query_gpu(gpu_id, pids):
+    # Returns (utilization in %, memory in MB used by pids), None when
+    # nvidia-smi is not available. The utilization is the one of the whole
+    # GPU, which may be shared with other trials.
+    try:
+        utilization = subprocess.check_output(
+            ["nvidia-smi", "-i", str(gpu_id),
+             "--query-gpu=utilization.gpu",
+             "--format=csv,noheader,nounits"],
+            universal_newlines=True)
+        apps = subprocess.check_output(
+            ["nvidia-smi", "-i", str(gpu_id),
+             "--query-compute-apps=pid,used_memory",
+             "--format=csv,noheader,nounits"],
+            universal_newlines=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    memory = 0.
+    for line in apps.splitlines():
+        try:
+            pid, used_memory = [value.strip() for value in line.split(",")]
+            if int(pid) in pids:
+                memory += float(used_memory)
+        except ValueError:
+            continue
+
+    return float(utilization.strip().splitlines()[0]), memory
+
+
+class ResourceMonitor(object):
+    # Samples the resources used by the process of a trial and its children
+    # (data loaders for instance). Each source is skipped for good as soon as
+    # it is not available.
+
+    def __init__(self, pid, gpu_id=None, interval=TELEMETRY_INTERVAL):
+        self.pid = pid
+        self.gpu_id = gpu_id
+        self.interval = interval
+        # The first sample is taken after a full interval, CPU usage is
+        # measured over it
+        self.last_time = time.time()
+        self.step = 0
+        # Kept between samples, psutil measures CPU usage since the last call
+        self.processes = {}
+
+        self.use_psutil = psutil is not None and interval > 0
+        if psutil is None:
+            logger.debug("psutil is not installed, CPU, memory and I/O of "
+                         "the trials are not monitored")
+        self.use_gpu = gpu_id is not None and interval > 0
+
+        if self.use_psutil:
+            for process in self._get_processes():
+                try:
+                    process.cpu_percent()
+                except psutil.Error:
+                    continue
+
+    def _get_processes(self):
+        try:
+            root = self.processes.get(self.pid) or psutil.Process(self.pid)
+            processes = [root] + root.children(recursive=True)
+        except psutil.Error:
+            return []
+
+        self.processes = dict(
+            (process.pid, self.processes.get(process.pid, process))
+            for process in processes)
+
+        return list(self.processes.values())
+
+    def _sample_process(self):
+        cpu = rss = read = write = 0.
+        for process in self._get_processes():
+            try:
+                cpu += process.cpu_percent()
+                rss += process.memory_info().rss
+                io = process.io_counters()
+                read += io.read_bytes
+                write += io.write_bytes
+            except (psutil.Error, AttributeError, NotImplementedError):
+                # Terminated in between, or no I/O counters on this platform
+                continue
+
+        return {"cpu_percent": cpu, "rss_mb": rss / MB,
+                "io_read_mb": read / MB, "io_write_mb": write / MB}
+
+    def sample(self):
+        values = {}
+        if self.use_psutil:
+            values.update(self._sample_process())
+
+        if self.use_gpu:
+            pids = set(self.processes) if self.processes else set([self.pid])
+            gpu = query_gpu(self.gpu_id, pids)
+            if gpu is None:
+                logger.debug("nvidia-smi is not available, GPUs of the trials "
+                             "are not monitored")
+                self.use_gpu = False
+            else:
+                values["gpu_util"], values["gpu_memory_mb"] = gpu
+
+        return values
+
+    def log(self, run):
+        # Logs a sample on the run if the interval elapsed
+        if not (self.use_psutil or self.use_gpu):
+            return
+
+        now = time.time()
+        if now - self.last_time < self.interval:
+            return
+        self.last_time = now
+
+        for name, value in self.sample().items():
+            run.log_scalar(PREFIX + name, value, self.step)
+        self.step += 1
@@ -6,6 +6,7 @@ import sys
 from sacred import Experiment
 
 import protopt.status
+from protopt.checkpoints import is_local
 
 
 DEBUG = "--debug" in sys.argv
@@ -151,22 +152,30 @@ class Trial(object):
             "--unobserved": False,
             "--enforce_clean": False}  # not DEBUG}
 
+        if self.experiment.capture_mode is not None:
+            options["--capture"] = self.experiment.capture_mode
+
         options.update(run_options)
 
-        # Means we are going to run a job from scratch (not resuming)
+        # Means we are going to run a job from scratch (not resuming), or
+        # resume one from a checkpoint migrated from another cluster
         # We set dataroot and save specific to current cluster
         is_a_queued_trial = self.row is not None and "host" not in self.row
+        checkpoint = (self.row or {}).get("info", {}).get("checkpoint", {})
+        is_migrated = "artifact" in checkpoint and not is_local(checkpoint)
 
-        if not options["--queue"] and is_a_queued_trial:
+        if not options["--queue"] and (is_a_queued_trial or is_migrated):
             config_updates["data_path"] = os.environ.get("DATA_PATH", ".")
 
             sorted_profiles = [name for name, _
                                in self.experiment.space.iter_profiles()
                                if name is not None]
 
+            # One directory per trial, scripts of concurrent trials must not
+            # write in the same one
             config_updates["save_path"] = os.path.join(*(
                 [self.experiment.dir_path] +
-                sorted_profiles))
+                sorted_profiles + [str(self.id)]))
 
             if "tensorboard" in self.experiment.default_setting:
                 config_updates["tensorboard"] = os.path.join(*(
@@ -181,13 +190,18 @@ class Trial(object):
 
         return ex
 
-    def queue(self):
+    def queue(self, priority=None):
         # Clean
         self.setting["data_path"] = (
             self.experiment.default_setting["data_path"])
         self.setting["save_path"] = (
             self.experiment.default_setting["save_path"])
 
-        self._run({"--queue": True})
+        observer = self.experiment.database.mongo_observer
+        observer.priority = priority
+        try:
+            self._run({"--queue": True})
+        finally:
+            observer.priority = None
         self.row = self.experiment.database.mongo_observer.run_entry
         self.setting = self.row["config"]
@@ -1,6 +1,8 @@
 import six
 import sys
 
+from protopt.status import RELEASED
+
 
 try:
     from sacred.utils import SacredInterrupt
@@ -37,10 +39,23 @@ class SacredSelectionError(RuntimeError):
     pass
 
 
+class LostClaim(RuntimeError):
+    # The trial was reaped and claimed by another worker while this one was
+    # still running it. Nothing is saved, the other worker owns the run now.
+    pass
+
+
 class ClusterProblem(Interrupt):
     STATUS = "CLUSTER_PROBLEM"
 
 
+class StagingProblem(Interrupt):
+    # The dataset could not be staged on the node. Nothing is wrong with the
+    # trial and the script did not start, it is given back as it was before
+    # being claimed, see LeasedMongoObserver.
+    STATUS = RELEASED
+
+
 class InvalidConfiguration(Interrupt):
     STATUS = "INVALID"
 
@@ -1,105 +1,877 @@
+import collections
 import copy
+import errno
+import fcntl
+import json
 import logging
 import os
+import select
+import shutil
 import signal
+import struct
 import subprocess
-from protopt.utils import TimeoutInterrupt
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+import six
+from six.moves import cPickle as pickle
+from six.moves import queue, shlex_quote
+
+from protopt import client
+from protopt.checkpoints import CheckpointStore, get_location
+from protopt.staging import stage_data_path
+from protopt.status import SCRIPT_FAILURE
+from protopt.telemetry import ResourceMonitor
+from protopt.utils import LostClaim, TimeoutInterrupt
 
 
 logger = logging.getLogger(__name__)
 
+# Maximum number of lines of the script's output echoed in the logs per second
+ECHO_RATE = 20
+# Number of last lines of the script's output kept for error reports
+TAIL_SIZE = 200
+
+# Signal forwarded to the scripts when the scheduler preempts the worker, and
+# seconds they are given to write a checkpoint before being killed.
+PREEMPTION_SIGNAL = getattr(
+    signal, os.environ.get("PROTOPT_PREEMPTION_SIGNAL", "SIGTERM"))
+# Slurm sends SIGKILL KillWait seconds (30 by default) after SIGTERM, the
+# grace must be shorter. Jobs warned earlier with sbatch --signal can use a
+# longer one.
+PREEMPTION_GRACE = int(os.environ.get("PROTOPT_PREEMPTION_GRACE", 25))
+
+# File of save_path in which scripts write the step of their last checkpoint
+# once it is safely on disk, see protopt.client.checkpoint_done(). Suffixed by
+# the id of the run, trials of old experiments share their save_path.
+CHECKPOINT_MARKER = ".protopt_checkpoint"
+
+
+# Suffix of the metric holding the time at which the script reported each
+# value of another one, in seconds since the epoch
+TIMESTAMP_SUFFIX = "_timestamp"
+
+
+# Captured at import, threading.main_thread() does not exist in Python 2
+_MAIN_THREAD = threading.current_thread()
+
+
+def _is_main_thread():
+    main_thread = getattr(threading, "main_thread", lambda: _MAIN_THREAD)()
+    return threading.current_thread() is main_thread
 
-def sigterm_handler(signal, frame):
-    if sigterm_handler.triggered:
-        return
-    else:
-        sigterm_handler.triggered = True
 
-    raise TimeoutInterrupt("Experiment killed by the scheduler")
+class Preemption(object):
+    # Shared by all the trials of the process. The handler only records the
+    # request and forwards the signal, the trials wind down in their own
+    # thread.
 
+    def __init__(self):
+        self.requested_at = None
+        self.processes = set()
+        # Reentrant, the handler runs in the main thread which may hold it
+        self.lock = threading.RLock()
 
-sigterm_handler.triggered = False
+    @property
+    def requested(self):
+        return self.requested_at is not None
+
+    def install(self):
+        # Signal handlers can only be set from the main thread, workers of a
+        # pool rely on the one installed by the supervisor, see base.run().
+        if not _is_main_thread():
+            return
+
+        signal.signal(signal.SIGTERM, self.handler)
+        if PREEMPTION_SIGNAL != signal.SIGTERM:
+            signal.signal(PREEMPTION_SIGNAL, self.handler)
+
+    def handler(self, signum, frame):
+        self.request("the scheduler")
+
+    def request(self, origin):
+        # Also used to wind down the workers of a pool on KeyboardInterrupt
+        if self.requested:
+            return
+
+        self.requested_at = time.time()
+        logger.info("Preemption requested by %s, giving %d seconds to the "
+                    "trials to checkpoint" % (origin, PREEMPTION_GRACE))
+
+        with self.lock:
+            for process in self.processes:
+                self._forward(process)
+
+    def register(self, process):
+        with self.lock:
+            self.processes.add(process)
+
+        # The request may have come while the script was starting
+        if self.requested:
+            self._forward(process)
+
+    def unregister(self, process):
+        with self.lock:
+            self.processes.discard(process)
+
+    def is_over(self, marker):
+        # Either the script confirmed its checkpoint or it ran out of time
+        if not self.requested:
+            return False
+
+        checkpoint = marker.read()
+        if checkpoint is not None and checkpoint["time"] >= self.requested_at:
+            return True
+
+        return time.time() - self.requested_at > PREEMPTION_GRACE
+
+    @staticmethod
+    def _forward(process):
+        try:
+            process.send_signal(PREEMPTION_SIGNAL)
+        except OSError:
+            # Already terminated
+            pass
+
+
+preemption = Preemption()
+
+
+class CheckpointMarker(object):
+    def __init__(self, path, trial_id=None):
+        self.path = path
+        self.trial_id = trial_id
+        self.last = None
+        # The checkpoints are the content of the directory of the marker
+        self.save_path = os.path.dirname(path) if path is not None else None
+
+    def read(self):
+        if self.path is None:
+            return None
+
+        try:
+            mtime = os.path.getmtime(self.path)
+            with open(self.path) as f:
+                content = f.read().strip()
+        except (IOError, OSError):
+            return None
+
+        try:
+            step = int(content)
+        except ValueError:
+            step = None
+
+        return dict(step=step, time=mtime)
+
+    def update(self, info):
+        # Returns True if a new checkpoint was written since the last update
+        checkpoint = self.read()
+        if checkpoint is None or checkpoint == self.last:
+            return False
+
+        self.last = checkpoint
+        info["checkpoint"] = get_location(checkpoint, self.save_path,
+                                          self.trial_id)
+        return True
 
 
 def fake_fct_signature(defaults, _run, *args, **kwargs):
+    # Runs the script given in the configuration in a new process
     assert len(args) == 0
-    # args = dict_to_options(_run.config, impn.main.parse_args([]))
-    # return impn.main.train(args, run=_run)
 
+    args, env, marker = _prepare(defaults, _run)
+    script = args.pop("script")
+
+    def spawn(child_metrics_fd):
+        # Build command line based on arguments
+        command = [script]
+        for (key, value) in args.items():
+            if isinstance(value, bool) and value:
+                command.append("--%s" % key)
+            elif not isinstance(value, bool):
+                command += ["--%s" % key, str(value)]
+
+        logger.info("Running command:\n%s" %
+                    " ".join(shlex_quote(part) for part in command))
+
+        if six.PY3:
+            fd_kwargs = dict(pass_fds=(child_metrics_fd, ))
+        else:
+            fd_kwargs = dict(close_fds=False)
+
+        return subprocess.Popen(command, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                env=env, **fd_kwargs)
+
+    with stage_data_path(args):
+        return _monitor(spawn, env, _run, marker)
+
+
+def fork_fct_signature(fct, defaults, _run, *args, **kwargs):
+    # Calls fct(args, run) in a child of the fork server, so that the imports
+    # of the training code are only paid once per worker. Use with
+    # functools.partial(fork_fct_signature, train, defaults). fct must be
+    # picklable, a function defined at the top level of a module.
+    assert len(args) == 0
+
+    args, env, marker = _prepare(defaults, _run)
+    args.pop("script", None)
+
+    def spawn(child_metrics_fd):
+        logger.info("Forking %s" % getattr(fct, "__name__", str(fct)))
+        return ForkedProcess(fct, dict(args), env)
+
+    with stage_data_path(args):
+        return _monitor(spawn, env, _run, marker)
+
+
+def _prepare(defaults, _run):
     args = copy.copy(defaults)
     args.update(_run.config)
 
     import pprint
     pprint.pprint(args)
 
-    # set gpu id in env var.
+    # set gpu id in env var. Only for the script, several trials may run in
+    # this process. None means CPU only.
     gpu_id = args.pop("gpu_id")
-    os.environ["CUDA_VISIBLE_DEVICES"] = str(gpu_id)
+    env = dict(os.environ)
+    env["CUDA_VISIBLE_DEVICES"] = str(gpu_id) if gpu_id is not None else ""
 
-    script = args.pop("script")
+    if args.get("save_path"):
+        marker = CheckpointMarker(os.path.join(
+            args["save_path"], "%s.%s" % (CHECKPOINT_MARKER, str(_run._id))),
+            _run._id)
+        env[client.CHECKPOINT_MARKER] = marker.path
+    else:
+        marker = CheckpointMarker(None)
 
     #
     args.pop("validate")
     args.pop("seed")
 
-    # Build command line based on arguments
-    arguments = ""
-    for (key, value) in args.items():
-        if isinstance(value, bool) and value:
-            arguments += "--%s " % key
-        elif not isinstance(value, bool):
-            arguments += "--%s %s " % (key, value)
-    arguments = arguments.strip()
+    return args, env, marker
+
+
+def _monitor(spawn, env, _run, marker):
+    preemption.install()
 
-    signal.signal(signal.SIGTERM, sigterm_handler)
+    # Metrics reported with protopt.client come through their own pipe. The
+    # lock makes sure that no other trial of the process starts while the
+    # write end is open here, otherwise it would inherit it and the channel
+    # would only close when both trials are over.
+    with _spawn_lock:
+        metrics_fd, child_metrics_fd = os.pipe()
+        env[client.METRICS_FD] = str(child_metrics_fd)
+        try:
+            process = spawn(child_metrics_fd)
+        except BaseException:
+            os.close(metrics_fd)
+            raise
+        finally:
+            # Only the script writes, otherwise the channel never closes
+            os.close(child_metrics_fd)
+    preemption.register(process)
+
+    resources = ResourceMonitor(
+        process.pid, gpu_id=env["CUDA_VISIBLE_DEVICES"] or None)
 
-    # Execute the command
-    command = "%s %s" % (script, arguments)
-    logger.info("Running command:\n%s" % command)
-    process = subprocess.Popen(command.split(), stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE)
+    # All streams are drained concurrently, otherwise a chatty stdout fills
+    # the pipe buffer and blocks the script.
+    lines = queue.Queue()
+    metrics = getattr(process, "metrics", None)
+    if metrics is None:
+        metrics = os.fdopen(metrics_fd, "rb")
+    else:
+        # Forked trials have their own channel, see ForkedProcess
+        os.close(metrics_fd)
 
-    info = ['n']
-    output = 'non empty for starter'
-    # Parse process' output
-    while output != '' or process.poll() is None:
+    readers = [
+        threading.Thread(target=_read_stream, args=(name, stream, lines))
+        for name, stream in [("stdout", process.stdout),
+                             ("stderr", process.stderr),
+                             ("metrics", metrics)]]
+    for reader in readers:
+        reader.daemon = True
+        reader.start()
+
+    parser = MetricParser()
+    echo = RateLimitedEcho(ECHO_RATE)
+    tail = collections.deque(maxlen=TAIL_SIZE)
+
+    # A resumed trial already knows its last checkpoint
+    checkpoint = _run.info.get("checkpoint")
+    if checkpoint is not None:
+        marker.last = dict(step=checkpoint["step"], time=checkpoint["time"])
+    store = _get_checkpoint_store(_run)
+
+    open_streams = len(readers)
+    while open_streams > 0:
+        if preemption.is_over(marker) or _is_fenced(_run):
+            break
+
+        if marker.update(_run.info):
+            logger.info("Checkpoint at step %s" % str(marker.last["step"]))
+            if store is not None:
+                store.discard(checkpoint)
+            checkpoint = _run.info["checkpoint"]
+
+        resources.log(_run)
 
         try:
-            logger.debug("Waiting for script's stdout")
-            output = process.stderr.readline().lstrip("INFO:root:").strip()
-            logger.info("stderr: %s" % output)
-            if 'train_m' in output:
-                assert output.strip().split('\t')[0].lstrip('#') == 'n'
-                info += output.strip().split('\t')[1:]
-                logger.info("info: %s" % str(info))
-            if not output.startswith('#'):
-                columns = output.strip().split('\t')
-                try:  # TODO weak
-                    values = [float(x) for x in columns]
-                except ValueError:
-                    logger.info("continue")
-                    continue
-                epoch = values[0]
-                for key, value in zip(info[1:], values[1:]):
-                    logger.info("Logging %s: (%s, %s)" %
-                                (key, str(epoch), str(value)))
-                    _run.log_scalar(key, float(value), epoch)
-            # process output
-            # fetch line
-            # if line contains something important like train_m
-            #     (https://github.com/Thrandis/my-pytorch-cifar/blob/master/plot.py#L68)
-            # log it with the _run object.
-        except KeyboardInterrupt as e:
-            raise e
-
-    rc = process.poll()
+            # Timeout so that signals are handled while waiting
+            name, line = lines.get(timeout=1)
+        except queue.Empty:
+            continue
 
-    if rc > 0:
-        raise RuntimeError(process.stderr.read())
+        if line is None:
+            open_streams -= 1
+            continue
+
+        line = line.rstrip("\n")
+        if name == "metrics":
+            for key, value, step, timestamp in _parse_record(line):
+                _log_scalar(_run, key, value, step, timestamp)
+            continue
+
+        tail.append("%s: %s" % (name, line))
+        echo(name, line)
+
+        # Fallback for scripts which do not use protopt.client
+        if name == "stderr":
+            for key, value, epoch in parser.parse(line):
+                logger.debug("Logging %s: (%s, %s)" %
+                             (key, str(epoch), str(value)))
+                _run.log_scalar(key, value, epoch)
+
+    echo.flush()
+    if marker.update(_run.info) and store is not None:
+        store.discard(checkpoint)
+
+    if _is_fenced(_run):
+        # Another worker runs the trial now, it must not find two scripts
+        # writing in its save_path
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+        preemption.unregister(process)
+        raise LostClaim("Trial was claimed by another worker, script killed")
 
-    # Catch some errors?
+    if preemption.requested:
+        if process.poll() is None:
+            logger.info("Killing the script after preemption")
+            process.kill()
+        rc = process.wait()
+        preemption.unregister(process)
 
-    # Catch KeyboardInterrupt and Timeout:
-    #   # Kill the process, set status as interrupted.
+        # A zero status means the script was done, preempted scripts exit
+        # with another one once their checkpoint is written
+        if rc != 0:
+            _migrate_checkpoint(store, _run)
+            raise TimeoutInterrupt("Experiment killed by the scheduler")
+
+        logger.info("Script completed in spite of the preemption")
+        return rc
+
+    rc = process.wait()
+    preemption.unregister(process)
+
+    if rc > 0:
+        # Tells the feasibility model that the configuration is to blame
+        _run.info["failure"] = SCRIPT_FAILURE
+        raise RuntimeError("\n".join(tail))
 
     return rc
+
+
+_spawn_lock = threading.Lock()
+
+
+def _is_fenced(_run):
+    # See LeasedMongoObserver
+    return any(getattr(observer, "fenced", False)
+               for observer in _run.observers)
+
+
+def _get_checkpoint_store(_run):
+    for observer in _run.observers:
+        if getattr(observer, "fs", None) is not None:
+            return CheckpointStore(observer.fs)
+
+    return None
+
+
+def _migrate_checkpoint(store, _run):
+    # Lets the interrupted trial resume on any cluster, see
+    # protopt.checkpoints.MIGRATION_SIZE
+    checkpoint = _run.info.get("checkpoint")
+    if store is None or checkpoint is None or "path" not in checkpoint:
+        return
+
+    try:
+        checkpoint = store.upload(_run._id, checkpoint)
+    except Exception as e:
+        logger.warning("Could not upload the checkpoint: %s" % str(e))
+        return
+
+    if checkpoint is not None:
+        _run.info["checkpoint"] = checkpoint
+
+
+def _set_cloexec(fd):
+    # Python 2 lets every script started with subprocess inherit the fd
+    fcntl.fcntl(fd, fcntl.F_SETFD,
+                fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+
+def _set_blocking(fd):
+    fcntl.fcntl(fd, fcntl.F_SETFL,
+                fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+
+
+def _read_exactly(fd, size):
+    chunks = []
+    while size > 0:
+        try:
+            chunk = os.read(fd, size)
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+
+        if not chunk:
+            return None
+
+        chunks.append(chunk)
+        size -= len(chunk)
+
+    return b"".join(chunks)
+
+
+def _send(fd, message):
+    # Messages between the worker and the fork server are pickles prefixed
+    # by their length
+    data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+    data = struct.pack("!I", len(data)) + data
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def _receive(fd):
+    # Returns None once the other end is closed
+    header = _read_exactly(fd, 4)
+    if header is None:
+        return None
+
+    data = _read_exactly(fd, struct.unpack("!I", header)[0])
+    if data is None:
+        return None
+
+    return pickle.loads(data)
+
+
+def _serve(requests_fd, responses_fd):
+    # Loop of the fork server. Requests are (request id, pickled (fct, args,
+    # env, paths of the FIFOs of the streams)), answered by ("started",
+    # request id, pid or the error) and later ("exited", pid, returncode).
+
+    # The signals are for the worker, which forwards them to the trials. The
+    # server must keep reaping its children in the meantime.
+    for signum in set([signal.SIGTERM, signal.SIGINT, PREEMPTION_SIGNAL]):
+        signal.signal(signum, signal.SIG_IGN)
+
+    children = set()
+    while True:
+        readable, _, _ = select.select([requests_fd], [], [], 0.1)
+        if readable:
+            request = _receive(requests_fd)
+            if request is None:
+                # The worker is gone, nobody can record the trials
+                break
+
+            request_id, payload = request
+            try:
+                pid = _fork_child(pickle.loads(payload),
+                                  (requests_fd, responses_fd))
+                children.add(pid)
+                _send(responses_fd, ("started", request_id, pid))
+            except Exception:
+                _send(responses_fd,
+                      ("started", request_id, traceback.format_exc()))
+
+        for pid in list(children):
+            reaped, status = os.waitpid(pid, os.WNOHANG)
+            if reaped == 0:
+                continue
+
+            children.discard(pid)
+            if os.WIFSIGNALED(status):
+                returncode = -os.WTERMSIG(status)
+            else:
+                returncode = os.WEXITSTATUS(status)
+            _send(responses_fd, ("exited", pid, returncode))
+
+    for pid in children:
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+
+def _fork_child(request, server_fds):
+    fct, args, env, paths = request
+
+    # The worker opened the read ends before sending the request, the open
+    # fails instead of blocking the server if it is not there anymore.
+    fds = []
+    try:
+        for path in paths:
+            fds.append(os.open(path, os.O_WRONLY | os.O_NONBLOCK))
+            _set_blocking(fds[-1])
+
+        # Flush before forking or buffered output would be written twice
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        pid = os.fork()
+        if pid == 0:
+            for fd in server_fds:
+                os.close(fd)
+            stdout_fd, stderr_fd, metrics_fd = fds
+            ForkedProcess._run_child(fct, args, env, metrics_fd, stdout_fd,
+                                     stderr_fd)
+    finally:
+        for fd in fds:
+            os.close(fd)
+
+    return pid
+
+
+class ForkServer(object):
+    # Forks the children of ForkedProcess. Forking the worker itself is not
+    # safe once it runs threads (the database driver, the heartbeats, the
+    # workers of a pool): the child gets their locks in whatever state they
+    # are and may wait forever on one of them. The server is forked before
+    # any thread is started, see --fork-server in base.parse_args(), and
+    # stays single threaded. The module of the training function is
+    # imported by the server with the first trial, the following ones start
+    # warm.
+
+    def __init__(self):
+        self.pid = None
+        self.requests_fd = None
+        self.alive = False
+        self.next_id = 0
+        # Filled by the thread reading the responses of the server
+        self.started = {}
+        self.returncodes = {}
+        self.condition = threading.Condition()
+
+    def start(self):
+        if self.pid is not None:
+            return
+
+        if threading.active_count() > 1:
+            raise RuntimeError(
+                "The fork server must be started before any thread")
+
+        requests_r, requests_w = os.pipe()
+        responses_r, responses_w = os.pipe()
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                os.close(requests_w)
+                os.close(responses_r)
+                _serve(requests_r, responses_w)
+                code = 0
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                # Never go back to the code of the worker
+                os._exit(code)
+
+        os.close(requests_r)
+        os.close(responses_w)
+        _set_cloexec(requests_w)
+        _set_cloexec(responses_r)
+
+        self.pid = pid
+        self.requests_fd = requests_w
+        self.alive = True
+
+        reader = threading.Thread(target=self._read_responses,
+                                  args=(responses_r, ))
+        reader.daemon = True
+        reader.start()
+
+    def _read_responses(self, fd):
+        while True:
+            response = _receive(fd)
+            if response is None:
+                break
+
+            kind, key, value = response
+            with self.condition:
+                if kind == "exited":
+                    self.returncodes[key] = value
+                else:
+                    self.started[key] = value
+                self.condition.notify_all()
+
+        with self.condition:
+            logger.warning("The fork server stopped")
+            self.alive = False
+            self.condition.notify_all()
+
+        os.close(fd)
+
+    def fork(self, fct, args, env, paths):
+        # Returns the pid of the child
+        payload = pickle.dumps((fct, args, env, paths),
+                               pickle.HIGHEST_PROTOCOL)
+
+        with self.condition:
+            if not self.alive:
+                raise RuntimeError("The fork server is not running, see "
+                                   "the --fork-server option")
+
+            request_id = self.next_id
+            self.next_id += 1
+            _send(self.requests_fd, (request_id, payload))
+
+            # With a timeout, signals are not handled during a plain wait in
+            # Python 2
+            while request_id not in self.started and self.alive:
+                self.condition.wait(1)
+            result = self.started.pop(request_id, None)
+
+        if result is None:
+            raise RuntimeError("The fork server stopped")
+        elif not isinstance(result, six.integer_types):
+            raise RuntimeError("Could not fork the trial:\n%s" % result)
+
+        return result
+
+    def get_returncode(self, pid, timeout=None):
+        # None while the child runs. Without the server there is no way to
+        # know when it ends, it is killed.
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while pid not in self.returncodes and self.alive:
+                remaining = (1 if deadline is None
+                             else min(1, deadline - time.time()))
+                if remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+
+            if pid in self.returncodes:
+                return self.returncodes.pop(pid)
+
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+        return -signal.SIGKILL
+
+
+fork_server = ForkServer()
+
+
+class ForkedProcess(object):
+    # Popen-like handle on a child of the fork server running fct(args, run).
+    # The child starts with the memory of the server, not the one of the
+    # worker. Metrics logged with run.log_scalar() go through the metric
+    # channel. The streams are FIFOs since the server cannot be given the
+    # ends of pipes created afterwards.
+
+    def __init__(self, fct, args, env):
+        tmp_dir = tempfile.mkdtemp(prefix="protopt-")
+        fds = []
+        try:
+            paths = [os.path.join(tmp_dir, name)
+                     for name in ["stdout", "stderr", "metrics"]]
+            for path in paths:
+                os.mkfifo(path)
+                fds.append(os.open(path, os.O_RDONLY | os.O_NONBLOCK))
+                _set_cloexec(fds[-1])
+
+            self.pid = fork_server.fork(fct, args, env, paths)
+        except BaseException:
+            for fd in fds:
+                os.close(fd)
+            raise
+        finally:
+            # The opened FIFOs outlive their path
+            shutil.rmtree(tmp_dir)
+
+        # The child holds the write ends now, reads block until it writes
+        # and end once it exits
+        for fd in fds:
+            _set_blocking(fd)
+        self.stdout, self.stderr, self.metrics = [
+            os.fdopen(fd, "rb") for fd in fds]
+        self.returncode = None
+
+    @staticmethod
+    def _run_child(fct, args, env, metrics_fd, stdout_fd, stderr_fd):
+        code = 1
+        try:
+            os.dup2(stdout_fd, 1)
+            os.dup2(stderr_fd, 2)
+            os.environ.clear()
+            os.environ.update(env)
+            os.environ[client.METRICS_FD] = str(metrics_fd)
+
+            # The server ignores them. The worker forwards the preemption,
+            # the function finds out with client.preemption_requested().
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(PREEMPTION_SIGNAL, client.on_preemption)
+
+            client._reporter = client.Reporter(metrics_fd)
+            fct(args, ForkedRun(args, client._reporter))
+            code = 0
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 1
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                # Never go back to the code of the server
+                os._exit(code)
+
+    def poll(self):
+        if self.returncode is None:
+            self.returncode = fork_server.get_returncode(self.pid, timeout=0)
+
+        return self.returncode
+
+    def wait(self):
+        if self.returncode is None:
+            self.returncode = fork_server.get_returncode(self.pid)
+
+        return self.returncode
+
+    def send_signal(self, signum):
+        # Not a child of the worker, its pid is only valid until the server
+        # reaps it
+        if self.poll() is None:
+            os.kill(self.pid, signum)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+
+class ForkedRun(object):
+    # The part of sacred's Run that training functions use
+
+    def __init__(self, config, reporter):
+        self.config = config
+        self.info = {}
+        self.reporter = reporter
+
+    def log_scalar(self, metric_name, value, step=None):
+        self.reporter.log_metric(metric_name, value, step)
+
+
+def _parse_record(line):
+    # See protopt.client.Reporter
+    try:
+        record = json.loads(line)
+        timestamp = record.get("timestamp")
+        return [(record["name"], float(record["value"]), record.get("step"),
+                 None if timestamp is None else float(timestamp))]
+    except (ValueError, TypeError, KeyError):
+        logger.warning("Invalid metric record: %s" % line)
+        return []
+
+
+def _log_scalar(run, name, value, step, timestamp=None):
+    # Sacred timestamps values when they are received. The time the script
+    # reported them is logged next to them, at the same step.
+    run.log_scalar(name, value, step)
+    if timestamp is not None:
+        run.log_scalar(name + TIMESTAMP_SUFFIX, timestamp, step)
+
+
+def _read_stream(name, stream, lines):
+    # Streams are read as bytes, output which is not valid UTF-8 must not
+    # stop the reader. The sentinel is always sent, _monitor() waits for it.
+    try:
+        for line in iter(stream.readline, b""):
+            lines.put((name, line.decode("utf-8", "replace")))
+    finally:
+        try:
+            stream.close()
+        finally:
+            lines.put((name, None))
+
+
+class RateLimitedEcho(object):
+    def __init__(self, max_lines_per_second):
+        self.max_lines_per_second = max_lines_per_second
+        self.window_start = time.time()
+        self.echoed = 0
+        self.dropped = 0
+
+    def flush(self):
+        if self.dropped:
+            logger.info("(%d lines of output were not echoed)" % self.dropped)
+        self.window_start = time.time()
+        self.echoed = 0
+        self.dropped = 0
+
+    def __call__(self, name, line):
+        if time.time() - self.window_start >= 1.:
+            self.flush()
+
+        if self.echoed < self.max_lines_per_second:
+            logger.info("%s: %s" % (name, line))
+            self.echoed += 1
+        else:
+            self.dropped += 1
+
+
+class MetricParser(object):
+    # Parses tab separated metric lines. The header line contains 'train_m'
+    # and gives the names of the columns, the first column is the epoch.
+
+    PREFIX = "INFO:root:"
+
+    def __init__(self):
+        self.info = ['n']
+
+    def parse(self, output):
+        output = output.strip()
+        if output.startswith(self.PREFIX):
+            output = output[len(self.PREFIX):]
+        if 'train_m' in output:
+            assert output.split('\t')[0].lstrip('#') == 'n'
+            self.info += output.split('\t')[1:]
+            logger.info("info: %s" % str(self.info))
+        if output.startswith('#'):
+            return []
+
+        columns = output.split('\t')
+        try:  # TODO weak
+            values = [float(x) for x in columns]
+        except ValueError:
+            if len(columns) == len(self.info) > 1:
+                logger.warning("Could not parse metric line: %s" % output)
+            return []
+
+        epoch = values[0]
+        return [(key, value, epoch)
+                for key, value in zip(self.info[1:], values[1:])]
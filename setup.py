@@ -22,5 +22,5 @@ setup(
              'bin/opt-run',
              'bin/opt-compile'],
     #         'bin/opt-stats']
-    # Optional: pymongo, sacred (my branch), gitpython
+    # Optional: pymongo, sacred (my branch), gitpython, psutil (telemetry)
 )